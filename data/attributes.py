@@ -8,6 +8,17 @@ The existing attributes file contains 312 attributes while the authors only use
 The implementation is only concerned with attributes for the following parts: head, breast, wing, tail
 
 This module contains a method to extract the necessary attributes and return binary vectors for all image instances
+
+It also contains a grouped encoding of all attributes: the <group>::<value> names of attributes.txt define a group
+table (offset and size of each group) and groups where no image has more than one value present are stored as a
+single int8 column holding the value index within the group (-1 when no value is present). The remaining,
+truly multi-valued groups are stored as a sparse multi-hot matrix in CSR form: the present attribute ids of image i
+are multi_hot_indices[multi_hot_indptr[i]:multi_hot_indptr[i + 1]]
+
+Usage: attributes.py <dir> <output_file> [--profile[=<report>]]
+
+where <dir> refers to the CUB-200 data directory and <output_file> is the .npz file receiving the grouped encoding
+With --profile, every step is timed and profiled and a report is written (see profiling.py)
 """
 
 from __future__ import absolute_import
@@ -15,9 +26,12 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import sys
 
 import numpy as np
 
+import profiling
+
 
 class Attribute:
     def __init__(self, identifier, name, value):
@@ -85,3 +99,99 @@ def attribute_vectors_for_images(dir, total_attributes):
                 attr_vec = np.append(attr_vec, is_present)
             counter += 1
     return image_attributes
+
+
+# Derive the attribute group table from attributes.txt, assuming the values of a group are listed contiguously
+# Returns (group names, offsets, sizes, value names) where the attributes with ids offsets[g] + 1 to
+# offsets[g] + sizes[g] are the values of group g
+def attribute_groups(attributes_file):
+    names = np.loadtxt(attributes_file, dtype=str, usecols=(1,), ndmin=1)
+    groups = np.array([n.split('::')[0] for n in names])
+    values = np.array([n.split('::')[1] for n in names])
+
+    starts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+    sizes = np.diff(np.append(starts, len(groups)))
+    assert len(np.unique(groups)) == len(starts), 'Attribute groups in %s are not contiguous' % attributes_file
+    return groups[starts], starts, sizes, values
+
+
+# Read image_attribute_labels.txt into an (images, attributes) int8 binary matrix
+def attribute_matrix(image_attributes_file, num_attributes):
+    labels = np.loadtxt(image_attributes_file, dtype=np.int64, usecols=(0, 1, 2), ndmin=2)
+    matrix = np.zeros((labels[:, 0].max(), num_attributes), dtype=np.int8)
+    present = labels[:, 2] == 1
+    matrix[labels[present, 0] - 1, labels[present, 1] - 1] = 1
+    return matrix
+
+
+# Split a binary attribute matrix into the grouped encoding
+# Returns (categorical, categorical_groups, multi_hot_indptr, multi_hot_indices, multi_hot_groups) where
+# categorical is an (images, len(categorical_groups)) int8 matrix of value indices (-1 for missing) and
+# multi_hot_indptr and multi_hot_indices hold the present attributes of the groups in multi_hot_groups in CSR form,
+# as 0-based attribute ids (columns of matrix) in increasing order
+def grouped_encoding(matrix, offsets, sizes):
+    present_per_group = np.add.reduceat(matrix, offsets, axis=1, dtype=np.int64)
+    single_valued = np.all(present_per_group <= 1, axis=0)
+
+    categorical_groups = np.flatnonzero(single_valued)
+    categorical = np.full((matrix.shape[0], len(categorical_groups)), -1, dtype=np.int8)
+    for column, g in enumerate(categorical_groups):
+        block = matrix[:, offsets[g]:offsets[g] + sizes[g]]
+        categorical[:, column] = np.where(present_per_group[:, g] > 0, block.argmax(axis=1), -1)
+
+    multi_hot_groups = np.flatnonzero(~single_valued)
+    in_multi_hot = np.zeros(matrix.shape[1], dtype=bool)
+    for g in multi_hot_groups:
+        in_multi_hot[offsets[g]:offsets[g] + sizes[g]] = True
+    rows, columns = np.nonzero(matrix * in_multi_hot)
+    multi_hot_indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=matrix.shape[0]), out=multi_hot_indptr[1:])
+    multi_hot_indices = columns.astype(np.int16)
+    return categorical, categorical_groups, multi_hot_indptr, multi_hot_indices, multi_hot_groups
+
+
+# Expand the CSR multi-hot attributes of grouped_encoding back into an (images, num_attributes) int8 binary matrix
+def multi_hot_matrix(multi_hot_indptr, multi_hot_indices, num_attributes):
+    matrix = np.zeros((len(multi_hot_indptr) - 1, num_attributes), dtype=np.int8)
+    matrix[np.repeat(np.arange(len(multi_hot_indptr) - 1), np.diff(multi_hot_indptr)), multi_hot_indices] = 1
+    return matrix
+
+
+# Write the grouped encoding of the attributes in the CUB-200 data directory <dir> to the .npz file output_file
+def encode_attributes(dir, output_file):
+    with profiling.stage('attribute_groups'):
+        group_names, offsets, sizes, value_names = attribute_groups(os.path.join(dir, 'attributes.txt'))
+    with profiling.stage('attribute_matrix'):
+        matrix = attribute_matrix(
+            os.path.join(dir, 'CUB_200_2011', 'attributes', 'image_attribute_labels.txt'), len(value_names))
+    with profiling.stage('grouped_encoding'):
+        categorical, categorical_groups, multi_hot_indptr, multi_hot_indices, multi_hot_groups = \
+            grouped_encoding(matrix, offsets, sizes)
+
+    np.savez(output_file, group_names=group_names, group_offsets=offsets, group_sizes=sizes,
+             value_names=value_names, categorical=categorical, categorical_groups=categorical_groups,
+             multi_hot_indptr=multi_hot_indptr, multi_hot_indices=multi_hot_indices,
+             multi_hot_groups=multi_hot_groups)
+    print('Encoded %d attributes of %d images as %d categorical columns and %d sparse multi-hot entries (%d of %d '
+          'groups multi-valued)' % (matrix.shape[1], matrix.shape[0], categorical.shape[1], len(multi_hot_indices),
+                                    len(multi_hot_groups), len(group_names)))
+
+
+if __name__ == '__main__':
+    profiling.pop_profile_flag(sys.argv, 'attributes')
+
+    # Quit if invalid arguments
+    if len(sys.argv) != 3:
+        print('Invalid usage\n'
+              'usage: attributes.py <dir> <output_file>',
+              file=sys.stderr)
+        sys.exit(-1)
+
+    directory = sys.argv[1]
+    output_file = sys.argv[2]
+
+    # The report is written even when a stage fails
+    try:
+        encode_attributes(directory, output_file)
+    finally:
+        profiling.finish()
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+
+# Local server of decoded image batches read from the TFRecord shards built by build_cub200_data.py
+
+"""
+The server memory-maps the shards of every split in <data_dir> once, decodes and resizes images in a single
+worker pool shared by all clients and hands out ready-made uint8 batches through shared memory. Clients connect
+over a Unix domain socket, so nothing is exposed on the network
+
+Each client chooses its split, batch size and seed and gets its own ring of <prefetch_depth> shared memory
+slots. The server keeps the slots the client is not holding filled ahead of time; a slot is only refilled
+once the client asks for the next batch, so a slow client never makes the server run ahead of it
+
+Protocol (one JSON object per line):
+  client: {"split": "train", "batch_size": 32, "seed": 1}
+  server: {"slots": [<shared memory names>], "shape": [<batch_size>, <height>, <width>, 3]}
+  client: "next"
+  server: {"slot": <index of the slot holding the batch>, "labels": [...]}
+  ...
+  client: "close"
+
+Usage: batch_server.py <data_dir> <socket_path> [--image_size N] [--num_workers N] [--prefetch_depth N]
+                       [--compression none|zlib|gzip]
+
+where <data_dir> refers to the output directory of build_cub200_data.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import glob
+import io
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+
+import numpy as np
+
+from multiprocessing import resource_tracker, shared_memory
+from PIL import Image
+
+from tfrecord_reader import load_shard, parse_example, record_offsets
+
+
+SPLITS = ['train', 'validation', 'test']
+
+# Shards memory-mapped (or decompressed) by a worker process, opened on first use
+_worker_shard_paths = []
+_worker_compression = 'none'
+_worker_shards = {}
+
+
+def _attach(name, track=True):
+    # Clients must not let their own resource tracker unlink a segment owned by the server when they exit.
+    # Workers share the resource tracker of the server and keep tracking on
+    if track:
+        return shared_memory.SharedMemory(name=name)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def _init_worker(shard_paths, compression):
+    global _worker_shard_paths, _worker_compression
+    _worker_shard_paths = shard_paths
+    _worker_compression = compression
+
+
+# Decode the records of a batch, resize them and write them to the shared memory segment <name>
+# records is a list of (shard index, offset, length), returns the labels of the batch
+def _fill_batch(name, shape, records):
+    segment = _attach(name)
+    try:
+        images = np.ndarray(shape, dtype=np.uint8, buffer=segment.buf)
+        labels = []
+        for i, (shard, offset, length) in enumerate(records):
+            if shard not in _worker_shards:
+                _worker_shards[shard] = load_shard(_worker_shard_paths[shard], _worker_compression)
+            example = parse_example(_worker_shards[shard][offset:offset + length])
+            image = Image.open(io.BytesIO(example['image/encoded'][0])).convert('RGB')
+            images[i] = np.asarray(image.resize((shape[2], shape[1]), Image.BILINEAR))
+            labels.append(example['image/class/label'][0])
+        del images
+        return labels
+    finally:
+        segment.close()
+
+
+# Free bytes of the shared memory file system, None where it is not known
+def _shared_memory_available():
+    if not hasattr(os, 'statvfs') or not os.path.isdir('/dev/shm'):
+        return None
+    stat = os.statvfs('/dev/shm')
+    return stat.f_bavail * stat.f_frsize
+
+
+class BatchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves batches of the shards in data_dir to clients connecting to socket_path."""
+
+    daemon_threads = True
+
+    def __init__(self, data_dir, socket_path, image_size=224, num_workers=4, prefetch_depth=4,
+                 compression='none'):
+        # The client holds one slot while the next one is filled
+        if prefetch_depth < 2:
+            raise ValueError('prefetch_depth must be at least 2, got %d' % prefetch_depth)
+        self.image_size = image_size
+        self.prefetch_depth = prefetch_depth
+
+        # Index the records of every shard as rows of (shard index, offset, length)
+        self.shard_paths = []
+        self.index = {}
+        for split in SPLITS:
+            rows = []
+            for path in sorted(glob.glob(os.path.join(data_dir, split, '%s-*-of-*' % split))):
+                buffer = load_shard(path, compression)
+                rows.extend((len(self.shard_paths), offset, length) for offset, length in record_offsets(buffer))
+                if compression == 'none':
+                    buffer.close()
+                self.shard_paths.append(path)
+            if rows:
+                self.index[split] = np.array(rows, dtype=np.int64)
+        if not self.index:
+            raise ValueError('No shards found in %s' % data_dir)
+
+        # Start the resource tracker before forking so that the workers share it with the server
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(self.shard_paths, compression))
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, _ClientHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class _ClientHandler(socketserver.StreamRequestHandler):
+
+    def _send(self, message):
+        self.wfile.write(json.dumps(message).encode('utf8') + b'\n')
+        self.wfile.flush()
+
+    def _receive(self):
+        line = self.rfile.readline()
+        return json.loads(line.decode('utf8')) if line else 'close'
+
+    def _next_records(self, batch_size):
+        # Draw the next batch from per-epoch permutations of the split, crossing epochs when needed
+        indices = []
+        while len(indices) < batch_size:
+            if self.cursor == len(self.order):
+                self.order = self.rng.permutation(len(self.records))
+                self.cursor = 0
+            take = min(batch_size - len(indices), len(self.order) - self.cursor)
+            indices.extend(self.order[self.cursor:self.cursor + take])
+            self.cursor += take
+        return [tuple(int(v) for v in self.records[i]) for i in indices]
+
+    def handle(self):
+        server = self.server
+        request = self._receive()
+        if request == 'close':
+            return
+        split = request.get('split', 'train')
+        if split not in server.index:
+            self._send({'error': 'Unknown split %s, available: %s' % (split, sorted(server.index))})
+            return
+        try:
+            batch_size = int(request.get('batch_size', 32))
+            depth = min(int(request.get('prefetch_depth', server.prefetch_depth)), server.prefetch_depth)
+        except (TypeError, ValueError):
+            self._send({'error': 'Invalid batch_size or prefetch_depth in request %s' % request})
+            return
+        if batch_size <= 0:
+            self._send({'error': 'batch_size must be positive, got %d' % batch_size})
+            return
+        if depth < 2:
+            self._send({'error': 'prefetch_depth must be at least 2, got %d' % depth})
+            return
+        seed = request.get('seed')
+        if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or not 0 <= seed < 2 ** 32):
+            self._send({'error': 'seed must be an integer in [0, 2**32) or null, got %r' % (seed,)})
+            return
+        shape = (batch_size, server.image_size, server.image_size, 3)
+
+        self.records = server.index[split]
+        self.rng = np.random.RandomState(seed)
+        self.order = self.rng.permutation(len(self.records))
+        self.cursor = 0
+
+        # Slots larger than the free shared memory are refused before they are allocated
+        size = int(np.prod(shape))
+        available = _shared_memory_available()
+        if available is not None and size * depth > available:
+            self._send({'error': 'Cannot allocate %d slots of %s: %d bytes of shared memory available' % (
+                depth, shape, available)})
+            return
+        slots = []
+        try:
+            for _ in range(depth):
+                slots.append(shared_memory.SharedMemory(create=True, size=size))
+        except (OSError, ValueError, OverflowError, MemoryError) as e:
+            for s in slots:
+                s.close()
+                s.unlink()
+            self._send({'error': 'Cannot allocate %d slots of %s: %s' % (depth, shape, e)})
+            return
+        free = list(range(depth))
+        pending = collections.deque()
+        held = None
+        try:
+            self._send({'slots': [s.name for s in slots], 'shape': shape})
+            while True:
+                # Fill every slot the client is not holding, then wait for the client
+                while free:
+                    slot = free.pop(0)
+                    result = server.pool.apply_async(
+                        _fill_batch, (slots[slot].name, shape, self._next_records(batch_size)))
+                    pending.append((slot, result))
+
+                if self._receive() != 'next':
+                    break
+                if held is not None:
+                    free.append(held)
+                held, result = pending.popleft()
+                try:
+                    labels = result.get()
+                except Exception as e:
+                    self._send({'error': str(e)})
+                    break
+                self._send({'slot': held, 'labels': labels})
+        except (IOError, OSError):
+            pass
+        finally:
+            for _, result in pending:
+                result.wait()
+            for s in slots:
+                s.close()
+                s.unlink()
+
+
+class BatchClient(object):
+    """Receives batches of a split from a BatchServer.
+
+    The images returned by next_batch are a view into shared memory that stays valid until the next call.
+    """
+
+    def __init__(self, socket_path, split='train', batch_size=32, seed=None, prefetch_depth=None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile('rwb')
+
+        request = {'split': split, 'batch_size': batch_size, 'seed': seed}
+        if prefetch_depth is not None:
+            request['prefetch_depth'] = prefetch_depth
+        reply = self._request(request)
+        self.shape = tuple(reply['shape'])
+        self._slots = [_attach(name, track=False) for name in reply['slots']]
+        self._images = [np.ndarray(self.shape, dtype=np.uint8, buffer=s.buf) for s in self._slots]
+
+    def _request(self, message):
+        self._file.write(json.dumps(message).encode('utf8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise IOError('Connection closed by the batch server')
+        reply = json.loads(line.decode('utf8'))
+        if 'error' in reply:
+            raise IOError(reply['error'])
+        return reply
+
+    def next_batch(self):
+        """Return the next (images, labels) batch as a uint8 array and an int64 array."""
+        reply = self._request('next')
+        return self._images[reply['slot']], np.array(reply['labels'], dtype=np.int64)
+
+    def close(self):
+        if self._socket is None:
+            return
+        try:
+            self._file.write(json.dumps('close').encode('utf8') + b'\n')
+            self._file.flush()
+        except (IOError, OSError):
+            pass
+        self._images = []
+        for s in self._slots:
+            s.close()
+        self._file.close()
+        self._socket.close()
+        self._socket = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve decoded CUB-200 batches over a Unix domain socket.')
+    parser.add_argument('data_dir', help='output directory of build_cub200_data.py')
+    parser.add_argument('socket_path', help='path of the Unix domain socket to listen on')
+    parser.add_argument('--image_size', type=int, default=224, help='height and width of served images')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of decoding processes shared by all clients')
+    parser.add_argument('--prefetch_depth', type=int, default=4,
+                        help='maximum number of shared memory slots per client (at least 2)')
+    parser.add_argument('--compression', default='none', choices=['none', 'zlib', 'gzip'],
+                        help='compression the shards were built with')
+    args = parser.parse_args()
+    if args.prefetch_depth < 2:
+        parser.error('--prefetch_depth must be at least 2 (one slot held by the client, one being filled)')
+
+    server = BatchServer(args.data_dir, args.socket_path, args.image_size, args.num_workers, args.prefetch_depth,
+                         args.compression)
+    print('Serving %s from %s on %s' % (
+        ', '.join('%d %s records' % (len(server.index[s]), s) for s in sorted(server.index)),
+        args.data_dir, args.socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+
+# Script comparing on-disk size and read throughput of the shard compression settings of build_cub200_data.py
+
+"""
+A sample of records is taken from the uncompressed shards of one split and rewritten with every combination of:
+
+  record compression: none, zlib and gzip at each of the given levels
+  image/encoded: as built, or losslessly optimised with jpegtran
+
+For every setting the on-disk size is reported together with the throughput of reading the shards, parsing the
+Example protos and decoding the JPEG data, using a single process and using one process per shard
+
+Usage: benchmark_compression.py --input_directory=<dir> [--split=validation] [--max_records=1000]
+                                [--compression_levels=1,6,9] [--num_processes=N]
+
+where <dir> refers to the output directory of build_cub200_data.py (built without compression)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from PIL import Image
+
+from shard_compression import COMPRESSION_TYPES, jpegtran_available, optimize_jpeg, record_options
+from tfrecord_reader import load_shard, parse_example, record_offsets
+
+tf.app.flags.DEFINE_string('input_directory', '/tmp/', 'Output directory of build_cub200_data.py')
+tf.app.flags.DEFINE_string('split', 'validation', 'Split whose shards are sampled')
+tf.app.flags.DEFINE_integer('max_records', 1000, 'Number of records in the benchmark')
+tf.app.flags.DEFINE_string('compression_levels', '1,6,9', 'Comma separated zlib/gzip levels')
+tf.app.flags.DEFINE_integer('num_processes', multiprocessing.cpu_count(),
+                            'Number of shards and reader processes of the multi-core measurement')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+# Read up to max_records serialized Examples from the uncompressed shards of a split
+def load_records(input_directory, split, max_records):
+    records = []
+    for path in sorted(glob.glob(os.path.join(input_directory, split, '%s-*-of-*' % split))):
+        buffer = load_shard(path)
+        records.extend(buffer[offset:offset + length] for offset, length in record_offsets(buffer))
+        buffer.close()
+        if len(records) >= max_records:
+            break
+    return records[:max_records]
+
+
+# Replace image/encoded of every record with its jpegtran optimised version
+def optimize_records(records):
+    optimized = []
+    for record in records:
+        example = tf.train.Example.FromString(record)
+        encoded = example.features.feature['image/encoded'].bytes_list.value
+        encoded[0] = optimize_jpeg(encoded[0])
+        optimized.append(example.SerializeToString())
+    return optimized
+
+
+# Write records to num_shards shards in directory, returns the shard paths and their total size in bytes
+def write_shards(records, directory, compression, level, num_shards):
+    paths = []
+    for shard, indices in enumerate(np.array_split(np.arange(len(records)), num_shards)):
+        path = os.path.join(directory, 'shard-%.5d-of-%.5d' % (shard, num_shards))
+        writer = tf.python_io.TFRecordWriter(path, options=record_options(compression, level))
+        for i in indices:
+            writer.write(records[i])
+        writer.close()
+        paths.append(path)
+    return paths, sum(os.path.getsize(p) for p in paths)
+
+
+def _read_and_decode(task):
+    path, compression = task
+    buffer = load_shard(path, compression)
+    count = 0
+    for offset, length in record_offsets(buffer):
+        example = parse_example(buffer[offset:offset + length])
+        Image.open(io.BytesIO(example['image/encoded'][0])).convert('RGB')
+        count += 1
+    return count
+
+
+# Return the number of images read and decoded per second with the given number of processes
+def read_throughput(paths, compression, num_processes):
+    tasks = [(p, compression) for p in paths]
+    start = time.time()
+    if num_processes == 1:
+        count = sum(_read_and_decode(t) for t in tasks)
+    else:
+        pool = multiprocessing.Pool(num_processes)
+        try:
+            count = sum(pool.map(_read_and_decode, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    return count / (time.time() - start)
+
+
+def main(unused_argv):
+    records = load_records(FLAGS.input_directory, FLAGS.split, FLAGS.max_records)
+    assert records, 'No records found for split %s in %s' % (FLAGS.split, FLAGS.input_directory)
+    levels = [int(l) for l in FLAGS.compression_levels.split(',') if l]
+
+    variants = [('as built', records)]
+    if jpegtran_available():
+        variants.append(('optimized', optimize_records(records)))
+    else:
+        print('jpegtran not found, skipping JPEG optimisation')
+
+    settings = [('none', -1)] + [(c, l) for c in COMPRESSION_TYPES if c != 'none' for l in levels]
+    print('Benchmarking %d %s records, %d processes' % (len(records), FLAGS.split, FLAGS.num_processes))
+    print('%-10s %-5s %5s %10s %7s %12s %12s' % ('jpeg', 'comp', 'level', 'size MB', 'ratio', '1-core img/s',
+                                                 '%d-core img/s' % FLAGS.num_processes))
+
+    work_directory = tempfile.mkdtemp(prefix='cub200_compression_')
+    try:
+        baseline = None
+        for variant, variant_records in variants:
+            for compression, level in settings:
+                directory = os.path.join(work_directory, '%s-%s-%d' % (variant.replace(' ', '_'), compression, level))
+                os.makedirs(directory)
+                paths, size = write_shards(variant_records, directory, compression, level, FLAGS.num_processes)
+                baseline = baseline or size
+                single = read_throughput(paths, compression, 1)
+                multi = read_throughput(paths, compression, FLAGS.num_processes)
+                print('%-10s %-5s %5s %10.2f %7.3f %12.1f %12.1f' % (
+                    variant, compression, level if compression != 'none' else '-', size / 1e6, size / baseline,
+                    single, multi))
+                shutil.rmtree(directory)
+    finally:
+        shutil.rmtree(work_directory)
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -65,14 +65,23 @@ from __future__ import division
 from __future__ import print_function
 
 from datetime import datetime
+import json
 import os
 import random
 import sys
 import threading
+import io
+import time
+import zlib
 
 import numpy as np
 import tensorflow as tf
 
+import profiling
+from cub_archive import IMAGES_PREFIX, CUBArchive
+from dataset_statistics import DatasetStatistics, write_statistics
+from shard_compression import COMPRESSION_TYPES, jpegtran_available, optimize_jpeg, record_options
+
 tf.app.flags.DEFINE_string('images_directory', '/tmp/', 'Images directory')
 tf.app.flags.DEFINE_string('output_directory', '/tmp/', 'Output data directory')
 
@@ -84,6 +93,37 @@ tf.app.flags.DEFINE_integer('validation_shards', 128,
 tf.app.flags.DEFINE_integer('num_threads', 8,
                             'Number of threads to preprocess the images.')
 
+# Per-channel pixel mean/std, image size and bbox area histograms and class
+# counts are accumulated on the decoded images and written to
+# output_directory/statistics.json.
+tf.app.flags.DEFINE_boolean('collect_statistics', False,
+                            'Collect dataset statistics while building.')
+
+# With the 'class' layout records are grouped by label so that no shard holds
+# more than one class (or, with fewer shards than classes, a contiguous range of
+# whole classes), and output_directory/<name>/class_index.json maps each class
+# id to its shard files and record ranges.
+tf.app.flags.DEFINE_string('shard_layout', 'mixed',
+                           'Shard layout, either mixed or class.')
+
+# Shards can be written with ZLIB or GZIP record compression, and the JPEG data
+# can be optimised losslessly with jpegtran (optimal Huffman tables, metadata
+# stripped) before it is stored in image/encoded.
+tf.app.flags.DEFINE_string('compression', 'none',
+                           'Record compression, one of none, zlib or gzip.')
+tf.app.flags.DEFINE_integer('compression_level', -1,
+                            'Compression level from 0 to 9, -1 for the default.')
+tf.app.flags.DEFINE_boolean('optimize_jpeg', False,
+                            'Losslessly optimise the stored JPEG data.')
+
+# A dry run times reading, decoding and encoding a deterministic sample of
+# each data set with the configured number of threads and extrapolates output
+# and shard sizes and wall time to the full data set. No shards are written.
+tf.app.flags.DEFINE_boolean('dry_run', False,
+                            'Print a build plan instead of building.')
+tf.app.flags.DEFINE_integer('dry_run_samples', 50,
+                            'Number of images per data set timed in a dry run.')
+
 # The classes file contains a map of IDs and valid labels.
 # Assumes that the file contains entries as such:
 #   1 001.Black_footed_Albatross
@@ -113,9 +153,46 @@ tf.app.flags.DEFINE_string('data_split_file', 'train_test_split.txt', 'Data spli
 # where each line has the number of the image in the dataset and the filename for that image
 tf.app.flags.DEFINE_string('images_file', 'images.txt', 'Images file')
 
+# The optional split assignment file fixes the data set of every image instead
+# of drawing the validation set at random from the train split.
+# Assumes that the file contains entries as such:
+# Black_Footed_Albatross_0046_18.jpg train
+# where each line has the image filename and one of train, validation or test
+tf.app.flags.DEFINE_string('split_assignment_file', '',
+                           'Optional split assignment file')
+
+# Each stage of the build (lookups, file listing, shard writing per data set)
+# is timed and profiled, including the worker threads, and the results are
+# written to this report (see profiling.py).
+tf.app.flags.DEFINE_string('profile', '',
+                           'Write a per-stage profiling report to this file.')
+
+# Shards can be built straight from the original CUB_200_2011.tgz archive in
+# one sequential pass, without extracting it. The metadata files are then read
+# from the archive (classes_file, images_file and data_split_file are looked
+# up by basename), bounding boxes are normalized from the archive's
+# bounding_boxes.txt and the JPEG data of every image (about 1.1 GB in all) is
+# held in memory until its record is written. A .tgz is always scanned. For an
+# uncompressed .tar with a member-offset index saved next to it, later builds
+# take the metadata from the index and read the images with seeks instead of
+# scanning every member: a dry run reads the image headers and the timed
+# sample only.
+tf.app.flags.DEFINE_string('archive', '', 'Optional CUB_200_2011.tgz archive')
+tf.app.flags.DEFINE_boolean('write_archive_index', False,
+                            'Save the member-offset index next to the archive.')
+
+# Bytes read from an archive member to probe the image size from its header.
+ARCHIVE_HEADER_BYTES = 1 << 16
+
 
 FLAGS = tf.app.flags.FLAGS
 
+# Archive and JPEG data by member name when building from an archive. With a
+# member-offset index of a .tar only the images read so far are held.
+_archive = None
+_archive_images = None
+_archive_lock = threading.Lock()
+
 
 def _int64_feature(value):
   """Wrapper for inserting int64 features into Example proto."""
@@ -231,6 +308,123 @@ class ImageCoder(object):
     return image
 
 
+def _read_image_data(filename):
+  """Read the raw bytes of an image file, from the archive if there is one.
+  Every image is read once by the build, so the archive bytes are released
+  here and memory shrinks as the shards are written.
+  """
+  if _archive_images is not None:
+    if filename not in _archive_images:
+      _read_archive_images([filename])
+    if FLAGS.dry_run:
+      return _archive_images[filename]
+    return _archive_images.pop(filename)
+  with tf.gfile.FastGFile(filename, 'rb') as f:
+    return f.read()
+
+
+def _read_metadata_lines(path):
+  """Read the lines of a metadata file, from the archive if there is one."""
+  if _archive is not None:
+    return _archive.lines(os.path.basename(path))
+  return tf.gfile.FastGFile(path, 'r').readlines()
+
+
+def _read_archive_images(names):
+  """Read the given images of an indexed .tar in one pass in offset order."""
+  names = [n for n in names if n not in _archive_images]
+  with _archive_lock:
+    for name, data in _archive.read_members(names):
+      _archive_images[name] = data
+
+
+def _load_archive(archive_path):
+  """Read the metadata and images of an archive.
+  Compressed archives and archives without a member-offset index are read in
+  one sequential pass. For a .tar with an index the metadata comes from the
+  index and the images are read with seeks when needed, all of them up front
+  unless this is a dry run.
+  Args:
+    archive_path: string, path to the CUB_200_2011.tgz archive.
+  """
+  global _archive, _archive_images
+  print('%s: Reading %s.' % (datetime.now(), archive_path))
+  sys.stdout.flush()
+  archive = CUBArchive(archive_path)
+  _archive_images = {}
+
+  if archive.seekable() and archive.has_index():
+    _archive = archive.load_index()
+    print('%s: Read %d metadata files using the index %s.' %
+          (datetime.now(), len(_archive.texts), _archive.index_path()))
+    if not FLAGS.dry_run:
+      _read_archive_images(_archive.image_names())
+      print('%s: Read %d images from %s.' %
+            (datetime.now(), len(_archive_images), archive_path))
+    sys.stdout.flush()
+    return
+
+  def keep_image(name, f):
+    _archive_images[name] = f.read()
+
+  _archive = archive.scan(keep_image)
+  print('%s: Read %d images and %d metadata files from %s.' %
+        (datetime.now(), len(_archive_images), len(_archive.texts),
+         archive_path))
+  if FLAGS.write_archive_index:
+    print('Wrote member-offset index to %s' % _archive.write_index())
+  sys.stdout.flush()
+
+
+def _archive_image_sizes(names):
+  """Return the (width, height) of archive images from their headers.
+  Images not held in memory are probed from their first ARCHIVE_HEADER_BYTES,
+  read with seeks; those whose header does not fit are read whole in a second
+  pass.
+  """
+  from PIL import Image
+
+  def image_size(data):
+    with Image.open(io.BytesIO(data)) as img:
+      return img.size
+
+  missing = [n for n in names if n not in _archive_images]
+  sizes = {}
+  truncated = []
+  for name, data in _archive.read_members(missing, ARCHIVE_HEADER_BYTES):
+    try:
+      sizes[name] = image_size(data)
+    except IOError:
+      truncated.append(name)
+  for name, data in _archive.read_members(truncated):
+    sizes[name] = image_size(data)
+  return [sizes[n] if n in sizes else image_size(_archive_images[n])
+          for n in names]
+
+
+def _build_archive_bounding_box_lookup():
+  """Build dictionary to retrieve normalized bounding boxes from the archive.
+  The raw <image_id> <x> <y> <width> <height> boxes of bounding_boxes.txt are
+  normalized with the image sizes read from the JPEG headers in memory.
+  """
+  from process_bounding_boxes import (load_bounding_boxes, load_image_paths,
+                                      transform_boxes)
+
+  image_ids, paths = load_image_paths(_archive.lines('images.txt'))
+  box_ids, boxes = load_bounding_boxes(_archive.lines('bounding_boxes.txt'))
+  assert np.array_equal(image_ids, box_ids), (
+      'Incongruence between images.txt and bounding_boxes.txt')
+  sizes = _archive_image_sizes([IMAGES_PREFIX + p for p in paths])
+  conventions, _ = transform_boxes(boxes, sizes)
+
+  images_to_bboxes = {}
+  for p, box in zip(paths, conventions['xyxy_norm'].tolist()):
+    images_to_bboxes.setdefault(os.path.basename(p), []).append(box)
+  print('Successfully normalized %d bounding boxes from the archive.' %
+        len(box_ids))
+  return images_to_bboxes
+
+
 def _is_png(filename):
   """Determine if a file contains a PNG format image.
   Args:
@@ -241,19 +435,19 @@ def _is_png(filename):
   return filename.endswith('.png')
 
 
-def _process_image(filename, coder):
+def _process_image(filename, coder, statistics=None):
   """Process a single image file.
   Args:
     filename: string, path to an image file e.g., '/path/to/example.JPG'.
     coder: instance of ImageCoder to provide TensorFlow image coding utils.
+    statistics: optional DatasetStatistics accumulating the decoded pixels.
   Returns:
     image_buffer: string, JPEG encoding of RGB image.
     height: integer, image height in pixels.
     width: integer, image width in pixels.
   """
   # Read the image file.
-  with tf.gfile.FastGFile(filename, 'rb') as f:
-    image_data = f.read()
+  image_data = _read_image_data(filename)
 
   # Convert any PNG to JPEG's for consistency.
   if _is_png(filename):
@@ -263,17 +457,25 @@ def _process_image(filename, coder):
   # Decode the RGB JPEG.
   image = coder.decode_jpeg(image_data)
 
+  if FLAGS.optimize_jpeg:
+    image_data = optimize_jpeg(image_data)
+
   # Check that image converted to RGB
   assert len(image.shape) == 3
   height = image.shape[0]
   width = image.shape[1]
   assert image.shape[2] == 3
 
+  if statistics is not None:
+    statistics.add_pixels(image)
+
   return image_data, height, width
 
 
 def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
-                               texts, labels, bboxes, num_shards):
+                               texts, labels, bboxes, num_shards,
+                               statistics=None, shard_boundaries=None,
+                               shard_labels=None):
   """Processes and saves list of images as TFRecord in 1 thread.
   Args:
     coder: instance of ImageCoder to provide TensorFlow image coding utils.
@@ -285,6 +487,12 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
     texts: list of strings; each string is human readable, e.g. 'dog'
     labels: list of integer; each integer identifies the ground truth
     num_shards: integer number of shards for this data set.
+    statistics: optional DatasetStatistics owned by this thread.
+    shard_boundaries: optional array of num_shards + 1 integers; shard i holds
+      files [shard_boundaries[i], shard_boundaries[i + 1]). Defaults to evenly
+      splitting the range of this thread.
+    shard_labels: optional dictionary receiving the list of labels written to
+      each output file name.
   """
   # Each thread produces N shards where N = int(num_shards / num_threads).
   # For instance, if num_shards = 128, and the num_threads = 2, then the first
@@ -293,9 +501,14 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
   assert not num_shards % num_threads
   num_shards_per_batch = int(num_shards / num_threads)
 
-  shard_ranges = np.linspace(ranges[thread_index][0],
-                             ranges[thread_index][1],
-                             num_shards_per_batch + 1).astype(int)
+  if shard_boundaries is None:
+    shard_ranges = np.linspace(ranges[thread_index][0],
+                               ranges[thread_index][1],
+                               num_shards_per_batch + 1).astype(int)
+  else:
+    first_shard = thread_index * num_shards_per_batch
+    shard_ranges = shard_boundaries[
+        first_shard:first_shard + num_shards_per_batch + 1]
   num_files_in_thread = ranges[thread_index][1] - ranges[thread_index][0]
 
   counter = 0
@@ -304,9 +517,12 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
     shard = thread_index * num_shards_per_batch + s
     output_filename = '%s-%.5d-of-%.5d' % (name, shard, num_shards)
     output_file = os.path.join(FLAGS.output_directory, name, output_filename)
-    writer = tf.python_io.TFRecordWriter(output_file)
+    writer = tf.python_io.TFRecordWriter(
+        output_file,
+        options=record_options(FLAGS.compression, FLAGS.compression_level))
 
     shard_counter = 0
+    written_labels = []
     files_in_shard = np.arange(shard_ranges[s], shard_ranges[s + 1], dtype=int)
     for i in files_in_shard:
       filename = filenames[i]
@@ -315,7 +531,8 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
       bbox = bboxes[i]
 
       try:
-        image_buffer, height, width = _process_image(filename, coder)
+        image_buffer, height, width = _process_image(filename, coder,
+                                                     statistics)
       except Exception as e:
         print(e)
         print('SKIPPED: Unexpected error while decoding %s.' % filename)
@@ -324,6 +541,9 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
       example = _convert_to_example(filename, image_buffer, label,
                                     text, bbox, height, width)
       writer.write(example.SerializeToString())
+      if statistics is not None:
+        statistics.add_example(label, height, width, bbox)
+      written_labels.append(label)
       shard_counter += 1
       counter += 1
 
@@ -333,6 +553,8 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
         sys.stdout.flush()
 
     writer.close()
+    if shard_labels is not None:
+      shard_labels[output_filename] = written_labels
     print('%s [thread %d]: Wrote %d images to %s' %
           (datetime.now(), thread_index, shard_counter, output_file))
     sys.stdout.flush()
@@ -342,6 +564,81 @@ def _process_image_files_batch(coder, thread_index, ranges, name, filenames,
   sys.stdout.flush()
 
 
+def _class_shard_boundaries(labels, num_shards):
+  """Compute shard boundaries that never split a shard across classes.
+  Args:
+    labels: list of integer, sorted so that each class is contiguous.
+    num_shards: integer number of shards for this data set.
+  Returns:
+    Array of num_shards + 1 integers; shard i holds records
+    [boundaries[i], boundaries[i + 1]). With fewer shards than classes each
+    shard holds a contiguous range of whole classes, otherwise every class is
+    split over a number of shards proportional to its size.
+  """
+  labels = np.asarray(labels)
+  if not len(labels):
+    # An empty split (e.g. no validation images) gives empty shards.
+    return np.zeros(num_shards + 1, dtype=int)
+  _, starts, counts = np.unique(labels, return_index=True, return_counts=True)
+  class_bounds = np.append(starts, len(labels))
+  num_classes = len(counts)
+
+  if num_shards <= num_classes:
+    # Snap evenly spaced boundaries to the nearest class boundary, keeping
+    # every shard non-empty.
+    targets = np.linspace(0, len(labels), num_shards + 1)
+    snapped = np.rint(np.interp(targets, class_bounds,
+                                np.arange(num_classes + 1))).astype(int)
+    snapped[0], snapped[-1] = 0, num_classes
+    for i in range(1, num_shards):
+      snapped[i] = min(max(snapped[i], snapped[i - 1] + 1),
+                       num_classes - (num_shards - i))
+    return class_bounds[snapped]
+
+  # Give every class at least one shard and share the rest by class size.
+  alloc = np.maximum(1, counts * num_shards // len(labels))
+  while alloc.sum() < num_shards:
+    alloc[np.argmax(counts / (alloc + 1.0))] += 1
+  while alloc.sum() > num_shards:
+    shrinkable = np.where(alloc > 1, counts / (alloc - 1.0), np.inf)
+    alloc[np.argmin(shrinkable)] -= 1
+  boundaries = [0]
+  for start, count, n in zip(starts, counts, alloc):
+    boundaries.extend(np.linspace(start, start + count, n + 1).astype(int)[1:])
+  return np.array(boundaries)
+
+
+def _write_class_index(name, texts, labels, shard_labels):
+  """Write the class to shard index of a data set with the class layout.
+  Args:
+    name: string, unique identifier specifying the data set
+    texts: list of strings; each string is human readable, e.g. 'dog'
+    labels: list of integer; each integer identifies the ground truth
+    shard_labels: dictionary mapping output file names to the list of labels
+      written to them.
+  """
+  class_texts = dict(zip(labels, texts))
+  index = {}
+  for output_filename in sorted(shard_labels):
+    written = shard_labels[output_filename]
+    start = 0
+    while start < len(written):
+      end = start
+      while end < len(written) and written[end] == written[start]:
+        end += 1
+      entry = index.setdefault(str(written[start]), {
+          'text': class_texts[written[start]], 'shards': []})
+      entry['shards'].append(
+          {'file': output_filename, 'start': start, 'end': end})
+      start = end
+
+  index_file = os.path.join(FLAGS.output_directory, name, 'class_index.json')
+  with open(index_file, 'w') as f:
+    json.dump(index, f, indent=2, sort_keys=True)
+  print('%s: Wrote class index for %d classes to %s' %
+        (datetime.now(), len(index), index_file))
+
+
 def _process_image_files(name, filenames, texts, labels, bboxes, num_shards):
   """Process and save list of images as TFRecord of Example protos.
   Args:
@@ -351,19 +648,33 @@ def _process_image_files(name, filenames, texts, labels, bboxes, num_shards):
     labels: list of integer; each integer identifies the ground truth
     bboxes: list of bounding boxes for each image
     num_shards: integer number of shards for this data set.
+  Returns:
+    DatasetStatistics merged over all threads if FLAGS.collect_statistics,
+    otherwise None.
   """
   assert len(filenames) == len(texts)
   assert len(filenames) == len(labels)
   assert len(filenames) == len(bboxes)
 
+  # Every thread writes at least one shard, so splits with fewer shards than
+  # FLAGS.num_threads (e.g. the single test shard) use one thread per shard.
+  num_threads = min(FLAGS.num_threads, num_shards)
+
   # Break all images into batches with a [ranges[i][0], ranges[i][1]].
-  spacing = np.linspace(0, len(filenames), FLAGS.num_threads + 1).astype(np.int)
+  # With the class layout batches start and end on shard boundaries.
+  shard_boundaries = None
+  shard_labels = {}
+  if FLAGS.shard_layout == 'class':
+    shard_boundaries = _class_shard_boundaries(labels, num_shards)
+    spacing = shard_boundaries[::num_shards // num_threads]
+  else:
+    spacing = np.linspace(0, len(filenames), num_threads + 1).astype(np.int)
   ranges = []
   for i in range(len(spacing) - 1):
     ranges.append([spacing[i], spacing[i + 1]])
 
   # Launch a thread for each batch.
-  print('Launching %d threads for spacings: %s' % (FLAGS.num_threads, ranges))
+  print('Launching %d threads for spacings: %s' % (num_threads, ranges))
   sys.stdout.flush()
 
   # Create a mechanism for monitoring when all threads are finished.
@@ -372,10 +683,16 @@ def _process_image_files(name, filenames, texts, labels, bboxes, num_shards):
   # Create a generic TensorFlow-based utility for converting all image codings.
   coder = ImageCoder()
 
+  # Each thread accumulates statistics on its own, they are merged at the end.
+  thread_statistics = [None] * len(ranges)
+  if FLAGS.collect_statistics:
+    thread_statistics = [DatasetStatistics() for _ in ranges]
+
   threads = []
   for thread_index in range(len(ranges)):
     args = (coder, thread_index, ranges, name, filenames,
-            texts, labels, bboxes, num_shards)
+            texts, labels, bboxes, num_shards, thread_statistics[thread_index],
+            shard_boundaries, shard_labels)
     t = threading.Thread(target=_process_image_files_batch, args=args)
     t.start()
     threads.append(t)
@@ -386,6 +703,16 @@ def _process_image_files(name, filenames, texts, labels, bboxes, num_shards):
         (datetime.now(), len(filenames)))
   sys.stdout.flush()
 
+  if FLAGS.shard_layout == 'class':
+    _write_class_index(name, texts, labels, shard_labels)
+
+  if not FLAGS.collect_statistics:
+    return None
+  statistics = DatasetStatistics()
+  for thread_stats in thread_statistics:
+    statistics.merge(thread_stats)
+  return statistics
+
 
 def _find_image_files(data_dir, classes_file):
   """Build a list of all images files and labels in the data set.
@@ -409,8 +736,7 @@ def _find_image_files(data_dir, classes_file):
     labels: list of integer; each integer identifies the ground truth.
   """
   print('Determining list of input files and labels from %s.' % data_dir)
-  unique_labels = [l.split()[1] for l in tf.gfile.FastGFile(
-      classes_file, 'r').readlines()]
+  unique_labels = [l.split()[1] for l in _read_metadata_lines(classes_file)]
 
   labels = []
   filenames = []
@@ -419,10 +745,17 @@ def _find_image_files(data_dir, classes_file):
   # Leave label index 0 empty as a background class.
   label_index = 1
 
+  if _archive is not None:
+    archive_images = _archive.image_names()
+
   # Construct the list of JPEG files and labels.
   for text in unique_labels:
-    jpeg_file_path = '%s/%s/*' % (data_dir, text)
-    matching_files = tf.gfile.Glob(jpeg_file_path)
+    if _archive is not None:
+      matching_files = sorted(n for n in archive_images
+                              if n.startswith(IMAGES_PREFIX + text + '/'))
+    else:
+      jpeg_file_path = '%s/%s/*' % (data_dir, text)
+      matching_files = tf.gfile.Glob(jpeg_file_path)
 
     labels.extend([label_index] * len(matching_files))
     texts.extend([text] * len(matching_files))
@@ -512,8 +845,8 @@ def _build_dataset_split_lookup(data_split_file, images_file):
     data_split_file: file containing set assignment for each image
     images_file: file containing image numbers and file names
   """
-  split_lines = tf.gfile.FastGFile(data_split_file, 'r').readlines()
-  images_lines = tf.gfile.FastGFile(images_file, 'r').readlines()
+  split_lines = _read_metadata_lines(data_split_file)
+  images_lines = _read_metadata_lines(images_file)
   images_to_dataset = {}
 
   num_assignments = 0
@@ -553,14 +886,17 @@ def _build_dataset_split_lookup(data_split_file, images_file):
   return images_to_dataset
 
 
-def _process_dataset(name, directory, num_shards, classes_file, images_to_bboxes, images_to_dataset):
-  """Process a complete data set and save it as a TFRecord.
+def _find_dataset_files(name, directory, classes_file, images_to_bboxes, images_to_dataset):
+  """Find the images, labels and bounding boxes of a data set.
   Args:
     name: string, unique identifier specifying the data set.
     directory: string, root path to the data set.
-    num_shards: integer number of shards for this data set.
     classes_file: string, path to the classes file.
     images_to_bboxes: dictionary mapping image file names to bounding boxes
+    images_to_dataset: dictionary mapping image file names to data sets
+  Returns:
+    filenames, texts, labels and bboxes of the images in the data set, grouped
+    by label if FLAGS.shard_layout is 'class'.
   """
   # Finds all filenames, texts, and labels
   filenames, texts, labels = _find_image_files(directory, classes_file)
@@ -569,7 +905,6 @@ def _process_dataset(name, directory, num_shards, classes_file, images_to_bboxes
   filtered_filenames = []
   filtered_texts = []
   filtered_labels = []
-  bboxes = []
 
   for (fn, t, l) in zip(filenames, texts, labels):
     filename = fn.split('/')
@@ -578,34 +913,255 @@ def _process_dataset(name, directory, num_shards, classes_file, images_to_bboxes
         filtered_filenames.append(fn)
         filtered_texts.append(t)
         filtered_labels.append(l)
-    bboxes = _find_image_bounding_boxes(filtered_filenames, images_to_bboxes)
+  bboxes = _find_image_bounding_boxes(filtered_filenames, images_to_bboxes)
+
+  # Group records by label for the class layout, keeping the shuffled order
+  # within each class.
+  if FLAGS.shard_layout == 'class':
+    order = sorted(range(len(filtered_labels)), key=lambda i: filtered_labels[i])
+    filtered_filenames = [filtered_filenames[i] for i in order]
+    filtered_texts = [filtered_texts[i] for i in order]
+    filtered_labels = [filtered_labels[i] for i in order]
+    bboxes = [bboxes[i] for i in order]
+
+  return filtered_filenames, filtered_texts, filtered_labels, bboxes
+
+
+def _read_split_assignment(split_assignment_file):
+  """Build dictionary to retrieve data assignment from a split assignment file
+  Args:
+    split_assignment_file: file containing entries in the form: <filename> <dataset>
+  """
+  images_to_dataset = {}
+  for l in tf.gfile.FastGFile(split_assignment_file, 'r').readlines():
+    if l.strip():
+      parts = l.split()
+      assert len(parts) == 2, ('Failed to parse: %s' % l)
+      images_to_dataset[parts[0]] = parts[1]
+  print('Successfully read %d dataset assignments.' % len(images_to_dataset))
+  return images_to_dataset
+
+
+def _process_dataset(name, directory, num_shards, classes_file, images_to_bboxes, images_to_dataset):
+  """Process a complete data set and save it as a TFRecord.
+  Args:
+    name: string, unique identifier specifying the data set.
+    directory: string, root path to the data set.
+    num_shards: integer number of shards for this data set.
+    classes_file: string, path to the classes file.
+    images_to_bboxes: dictionary mapping image file names to bounding boxes
+  Returns:
+    DatasetStatistics of the data set if FLAGS.collect_statistics, otherwise
+    None.
+  """
+  with profiling.stage('find_dataset_files/%s' % name):
+    filenames, texts, labels, bboxes = _find_dataset_files(
+        name, directory, classes_file, images_to_bboxes, images_to_dataset)
 
   if not os.path.exists(os.path.join(FLAGS.output_directory, name)):
-      os.mkdirs(os.path.join(FLAGS.output_directory, name))
-  _process_image_files(name, filtered_filenames, filtered_texts, filtered_labels, bboxes, num_shards)
+      os.makedirs(os.path.join(FLAGS.output_directory, name))
+  with profiling.stage('process_image_files/%s' % name):
+    return _process_image_files(name, filenames, texts, labels, bboxes, num_shards)
+
+
+def _time_image(filename, coder, label, text, bbox):
+  """Time the stages of converting a single image to a serialized Example.
+  Args:
+    filename: string, path to an image file e.g., '/path/to/example.JPG'.
+    coder: instance of ImageCoder to provide TensorFlow image coding utils.
+    label: integer, identifier for the ground truth for the network
+    text: string, unique human-readable, e.g. 'dog'
+    bbox: list of bounding boxes for the image
+  Returns:
+    read, decode and encode times in seconds and the serialized size in bytes.
+  """
+  start = time.time()
+  image_data = _read_image_data(filename)
+  read_done = time.time()
+
+  if _is_png(filename):
+    image_data = coder.png_to_jpeg(image_data)
+  image = coder.decode_jpeg(image_data)
+  decode_done = time.time()
+
+  if FLAGS.optimize_jpeg:
+    image_data = optimize_jpeg(image_data)
+  example = _convert_to_example(filename, image_data, label, text, bbox,
+                                image.shape[0], image.shape[1])
+  serialized = example.SerializeToString()
+  # Records are compressed one by one, which slightly overestimates the size
+  # of a compressed shard.
+  if FLAGS.compression != 'none':
+    serialized = zlib.compress(serialized, FLAGS.compression_level)
+  encode_done = time.time()
+  return (read_done - start, decode_done - read_done,
+          encode_done - decode_done, len(serialized))
+
+
+def _extrapolate(samples, total):
+  """Extrapolate per-image samples to a total with a 95% confidence interval.
+  Args:
+    samples: list of per-image measurements.
+    total: integer, number of images in the data set.
+  Returns:
+    estimate, lower bound and upper bound of the sum over the data set.
+  """
+  samples = np.asarray(samples, dtype=np.float64)
+  half_width = 0.0
+  if len(samples) > 1:
+    half_width = 1.96 * samples.std(ddof=1) / np.sqrt(len(samples))
+  estimate = samples.mean() * total
+  return estimate, max(estimate - half_width * total, 0.0), estimate + half_width * total
+
+
+def _plan_dataset(name, directory, num_shards, classes_file, images_to_bboxes,
+                  images_to_dataset, coder):
+  """Estimate the output size and build time of a data set without writing it.
+  Args:
+    name: string, unique identifier specifying the data set.
+    directory: string, root path to the data set.
+    num_shards: integer number of shards for this data set.
+    classes_file: string, path to the classes file.
+    images_to_bboxes: dictionary mapping image file names to bounding boxes
+    images_to_dataset: dictionary mapping image file names to data sets
+    coder: instance of ImageCoder to provide TensorFlow image coding utils.
+  Returns:
+    estimated output bytes and wall time in seconds of the data set.
+  """
+  with profiling.stage('find_dataset_files/%s' % name):
+    filenames, texts, labels, bboxes = _find_dataset_files(
+        name, directory, classes_file, images_to_bboxes, images_to_dataset)
+  if not filenames:
+    print('%s: no images, nothing to build.' % name)
+    return 0.0, 0.0
+
+  # Time a deterministic sample of the data set with the thread count of the
+  # build, sharing one coder as the build does, so that the wall time reflects
+  # contention on the coder session and the GIL rather than ideal scaling.
+  sample = random.Random(12345).sample(
+      range(len(filenames)), min(FLAGS.dry_run_samples, len(filenames)))
+  num_threads = min(FLAGS.num_threads, num_shards, len(sample))
+  timings = [None] * len(sample)
+  if _archive is not None:
+    # Only the sample is read from an indexed .tar, in offset order.
+    _read_archive_images([filenames[i] for i in sample])
+
+  def time_images(positions):
+    for j in positions:
+      i = sample[j]
+      timings[j] = _time_image(filenames[i], coder, labels[i], texts[i],
+                               bboxes[i])
+
+  with profiling.stage('time_images/%s' % name):
+    start = time.time()
+    threads = [threading.Thread(target=time_images,
+                                args=(range(t, len(sample), num_threads),))
+               for t in range(num_threads)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    burst_wall = time.time() - start
+  read_times, decode_times, encode_times, sizes = zip(*timings)
+  image_times = [sum(t[:3]) for t in timings]
+
+  total = len(filenames)
+  size, size_low, size_high = _extrapolate(sizes, total)
+  # The measured throughput of the burst sets the estimate, the spread of the
+  # per-image times its confidence interval.
+  busy, busy_low, busy_high = _extrapolate(image_times, total)
+  wall = burst_wall / len(sample) * total
+  spread = (busy_low / busy, busy_high / busy) if busy > 0 else (1.0, 1.0)
+  wall_low, wall_high = wall * spread[0], wall * spread[1]
+
+  print('%s: %d images in %d shards (%s layout, %s compression), '
+        'timed %d images' %
+        (name, total, num_shards, FLAGS.shard_layout, FLAGS.compression,
+         len(sample)))
+  print('  read %.2f ms, decode %.2f ms, encode %.2f ms per image' %
+        (1e3 * np.mean(read_times), 1e3 * np.mean(decode_times),
+         1e3 * np.mean(encode_times)))
+  print('  output %.1f MB (95%% CI %.1f - %.1f MB), %.2f MB per shard' %
+        (size / 1e6, size_low / 1e6, size_high / 1e6, size / num_shards / 1e6))
+  print('  wall time %.1f s (95%% CI %.1f - %.1f s) with %d threads, '
+        'measured speedup %.1fx over one thread' %
+        (wall, wall_low, wall_high, num_threads, busy / max(wall, 1e-9)))
+  sys.stdout.flush()
+  return size, wall
 
 
 def main(unused_argv):
+  if FLAGS.profile:
+    profiling.enable(FLAGS.profile)
+  try:
+    _build()
+  finally:
+    profiling.finish()
+
+
+def _build():
+  assert FLAGS.shard_layout in ('mixed', 'class'), (
+      'Unknown shard layout: %s' % FLAGS.shard_layout)
+  assert FLAGS.compression in COMPRESSION_TYPES, (
+      'Unknown compression: %s' % FLAGS.compression)
+  assert not FLAGS.optimize_jpeg or jpegtran_available(), (
+      'jpegtran is required by --optimize_jpeg')
   assert not FLAGS.train_shards % FLAGS.num_threads, (
       'Please make the FLAGS.num_threads commensurate with FLAGS.train_shards')
   assert not FLAGS.validation_shards % FLAGS.num_threads, (
       'Please make the FLAGS.num_threads commensurate with '
       'FLAGS.validation_shards')
-  print('Saving results to %s' % FLAGS.output_directory)
+  if not FLAGS.dry_run:
+    print('Saving results to %s' % FLAGS.output_directory)
 
   # Build map from filename to bounding box
-  images_to_bboxes = _build_bounding_box_lookup(FLAGS.bounding_boxes_file)
+  if FLAGS.archive:
+    with profiling.stage('load_archive'):
+      _load_archive(FLAGS.archive)
+    with profiling.stage('bounding_box_lookup'):
+      images_to_bboxes = _build_archive_bounding_box_lookup()
+  else:
+    with profiling.stage('bounding_box_lookup'):
+      images_to_bboxes = _build_bounding_box_lookup(FLAGS.bounding_boxes_file)
 
   # Build map from filename to data set (train, validation)
-  images_to_dataset = _build_dataset_split_lookup(FLAGS.data_split_file, FLAGS.images_file)
+  with profiling.stage('split_lookup'):
+    if FLAGS.split_assignment_file:
+      images_to_dataset = _read_split_assignment(FLAGS.split_assignment_file)
+    else:
+      images_to_dataset = _build_dataset_split_lookup(FLAGS.data_split_file, FLAGS.images_file)
+
+  if FLAGS.dry_run:
+    coder = ImageCoder()
+    plans = [
+        _plan_dataset('validation', FLAGS.images_directory,
+                      FLAGS.validation_shards, FLAGS.classes_file,
+                      images_to_bboxes, images_to_dataset, coder),
+        _plan_dataset('train', FLAGS.images_directory, FLAGS.train_shards,
+                      FLAGS.classes_file, images_to_bboxes, images_to_dataset,
+                      coder),
+        _plan_dataset('test', FLAGS.images_directory, 1, FLAGS.classes_file,
+                      images_to_bboxes, images_to_dataset, coder)]
+    print('Total: output %.1f MB, wall time %.1f s' %
+          (sum(p[0] for p in plans) / 1e6, sum(p[1] for p in plans)))
+    return
 
   # Run it!
-  _process_dataset('validation', FLAGS.images_directory,
-                   FLAGS.validation_shards, FLAGS.classes_file, images_to_bboxes, images_to_dataset)
-  _process_dataset('train', FLAGS.images_directory,
-                   FLAGS.train_shards, FLAGS.classes_file, images_to_bboxes, images_to_dataset)
-  _process_dataset('test', FLAGS.images_directory,
-                   1, FLAGS.classes_file, images_to_bboxes, images_to_dataset)
+  split_statistics = {}
+  split_statistics['validation'] = _process_dataset(
+      'validation', FLAGS.images_directory, FLAGS.validation_shards,
+      FLAGS.classes_file, images_to_bboxes, images_to_dataset)
+  split_statistics['train'] = _process_dataset(
+      'train', FLAGS.images_directory, FLAGS.train_shards,
+      FLAGS.classes_file, images_to_bboxes, images_to_dataset)
+  split_statistics['test'] = _process_dataset(
+      'test', FLAGS.images_directory, 1,
+      FLAGS.classes_file, images_to_bboxes, images_to_dataset)
+
+  if FLAGS.collect_statistics:
+    statistics_file = os.path.join(FLAGS.output_directory, 'statistics.json')
+    write_statistics(statistics_file, split_statistics)
+    print('Wrote dataset statistics to %s' % statistics_file)
 
 if __name__ == '__main__':
   tf.app.run()
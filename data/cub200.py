@@ -0,0 +1,311 @@
+#!/usr/bin/python
+
+# Pipeline running the CUB-200-2011 preprocessing steps as a graph of cached stages
+
+"""
+The preprocessing steps are modelled as stages that depend on each other:
+
+metadata      images.txt, classes.txt and train_test_split.txt parsed once into metadata.npz
+image_sizes   width and height of every image, read from the image headers
+boxes         bounding boxes in every convention of process_bounding_boxes.py
+attributes    grouped attribute encoding of attributes.py
+splits        train/validation/test assignment of partition_data.py, optionally materialised as link trees
+shards        TFRecord shards of build_cub200_data.py
+
+The output of every stage is cached in <dir>/.cub200_cache/<stage>/<key> where the key hashes the stage's input
+files, its configuration and the keys of the stages it depends on. Only stages whose key changed are rerun, so
+changing e.g. the shard count reuses everything up to the splits. NumPy, PIL and TensorFlow are only imported by
+the stages that need them (TensorFlow only in the build_cub200_data.py subprocess of the shards stage)
+
+Usage: cub200.py <dir> [<stage> ...] [--status] [--force <stage>] [options]
+
+where <dir> refers to the CUB-200 data directory (containing CUB_200_2011) and the given stages (default: all
+but shards) are brought up to date along with the stages they depend on
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+
+_SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage(object):
+    """A pipeline step with its dependencies, input files and configuration keys."""
+
+    def __init__(self, name, run, dependencies=(), inputs=(), config=(), version=1):
+        self.name = name
+        self.run = run
+        self.dependencies = list(dependencies)
+        self.inputs = list(inputs)
+        self.config = list(config)
+        # Bump the version of a stage when its implementation changes the output, only the stage and the stages
+        # depending on it are invalidated
+        self.version = version
+
+
+class Pipeline(object):
+    """Computes stage keys and runs stale stages, caching their outputs under the data directory."""
+
+    def __init__(self, directory, stages, config):
+        self.directory = directory
+        self.cub_directory = os.path.join(directory, 'CUB_200_2011')
+        self.cache_directory = os.path.join(directory, '.cub200_cache')
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.order = [stage.name for stage in stages]
+        self.config = config
+        self._keys = {}
+        # Stages brought up to date in this run, a forced stage reached through several paths runs only once
+        self._built = set()
+        self._fingerprints_file = os.path.join(self.cache_directory, 'fingerprints.json')
+        self._fingerprints = {}
+        if os.path.exists(self._fingerprints_file):
+            with open(self._fingerprints_file) as file:
+                self._fingerprints = json.load(file)
+
+    def path(self, relative_path):
+        return os.path.join(self.directory, relative_path)
+
+    def _fingerprint(self, relative_path):
+        # Files are hashed by content, memoized on size and modification time. Directories (the image tree) are
+        # fingerprinted from the names, sizes and modification times of their files to avoid reading every image
+        path = self.path(relative_path)
+        if not os.path.exists(path):
+            return None
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    info = os.stat(os.path.join(root, name))
+                    digest.update(('%s %d %d\n' % (os.path.relpath(os.path.join(root, name), path),
+                                                   info.st_size, int(info.st_mtime))).encode('utf8'))
+            return digest.hexdigest()
+
+        info = os.stat(path)
+        stamp = '%d %d' % (info.st_size, int(info.st_mtime * 1e6))
+        cached = self._fingerprints.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        self._fingerprints[path] = [stamp, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def key(self, name):
+        if name not in self._keys:
+            stage = self.stages[name]
+            description = {
+                'stage': name,
+                'version': stage.version,
+                'config': dict((k, self.config[k]) for k in stage.config),
+                'inputs': dict((p, self._fingerprint(p)) for p in stage.inputs),
+                'dependencies': dict((d, self.key(d)) for d in stage.dependencies),
+            }
+            encoded = json.dumps(description, sort_keys=True).encode('utf8')
+            self._keys[name] = hashlib.sha256(encoded).hexdigest()[:16]
+        return self._keys[name]
+
+    def output(self, name):
+        return os.path.join(self.cache_directory, name, self.key(name))
+
+    def is_cached(self, name):
+        return os.path.exists(os.path.join(self.output(name), 'manifest.json'))
+
+    def build(self, name, force=()):
+        """Bring a stage and its dependencies up to date, returns the output directory of the stage."""
+        if name in self._built:
+            return self.output(name)
+        stage = self.stages[name]
+        dependencies = dict((d, self.build(d, force)) for d in stage.dependencies)
+        output = self.output(name)
+        if self.is_cached(name) and name not in force:
+            self._built.add(name)
+            return output
+
+        print('[%s] running (key %s)' % (name, self.key(name)))
+        sys.stdout.flush()
+        if os.path.exists(output):
+            shutil.rmtree(output)
+        staging = '%s.tmp-%d' % (output, os.getpid())
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+
+        start = time.time()
+        stage.run(self, staging, dependencies)
+        with open(os.path.join(staging, 'manifest.json'), 'w') as file:
+            json.dump({'stage': name, 'key': self.key(name), 'seconds': time.time() - start,
+                       'config': dict((k, self.config[k]) for k in stage.config)}, file, indent=2, sort_keys=True)
+        os.rename(staging, output)
+        self._save_fingerprints()
+        self._built.add(name)
+        print('[%s] done in %.1f s: %s' % (name, time.time() - start, output))
+        return output
+
+    def _save_fingerprints(self):
+        if not os.path.isdir(self.cache_directory):
+            os.makedirs(self.cache_directory)
+        with open(self._fingerprints_file, 'w') as file:
+            json.dump(self._fingerprints, file)
+
+
+def _metadata(pipeline, output, dependencies):
+    import numpy as np
+    from episode_sampler import load_labels_and_splits
+    from partition_data import parse_classes
+
+    image_ids, labels, splits = load_labels_and_splits(pipeline.cub_directory)
+    images = np.loadtxt(os.path.join(pipeline.cub_directory, 'images.txt'), dtype=str, ndmin=2)
+    np.savez(os.path.join(output, 'metadata.npz'), image_ids=image_ids, paths=images[:, 1], labels=labels,
+             is_train=splits == 'train',
+             class_names=np.asarray(parse_classes(os.path.join(pipeline.cub_directory, 'classes.txt'))))
+
+
+def _load_metadata(dependencies):
+    import numpy as np
+    return np.load(os.path.join(dependencies['metadata'], 'metadata.npz'))
+
+
+def _image_sizes(pipeline, output, dependencies):
+    import numpy as np
+    from process_bounding_boxes import image_sizes
+
+    metadata = _load_metadata(dependencies)
+    sizes = image_sizes(os.path.join(pipeline.cub_directory, 'images'), metadata['paths'])
+    np.save(os.path.join(output, 'image_sizes.npy'), sizes.astype(np.int32))
+
+
+def _boxes(pipeline, output, dependencies):
+    import numpy as np
+    from process_bounding_boxes import load_bounding_boxes, transform_boxes, write_box_files
+
+    metadata = _load_metadata(dependencies)
+    sizes = np.load(os.path.join(dependencies['image_sizes'], 'image_sizes.npy'))
+    box_ids, boxes = load_bounding_boxes(os.path.join(pipeline.cub_directory, 'bounding_boxes.txt'))
+    assert np.array_equal(box_ids, metadata['image_ids']), 'Image ids of images.txt and bounding_boxes.txt differ'
+
+    conventions, valid = transform_boxes(boxes, sizes)
+    filenames = np.array([os.path.basename(p) for p in metadata['paths']])
+    write_box_files(output, filenames, conventions, sizes, valid)
+
+
+def _attributes(pipeline, output, dependencies):
+    from attributes import encode_attributes
+    encode_attributes(pipeline.directory, os.path.join(output, 'attributes.npz'))
+
+
+def _splits(pipeline, output, dependencies):
+    from partition_data import SPLITS, image_instances, materialise_splits, split_assignment, write_split_files
+
+    metadata = _load_metadata(dependencies)
+    ids = [str(i) for i in metadata['image_ids']]
+    train = [i for i, is_train in zip(ids, metadata['is_train']) if is_train]
+    test = [i for i, is_train in zip(ids, metadata['is_train']) if not is_train]
+    assignment = split_assignment(train, test, pipeline.config['validation_fraction'], pipeline.config['seed'])
+    write_split_files(output, assignment)
+
+    filename_of = dict(zip(ids, [os.path.basename(p) for p in metadata['paths']]))
+    with open(os.path.join(output, 'split_assignment.txt'), 'w') as file:
+        for split in SPLITS:
+            for id in assignment[split]:
+                file.write('%s %s\n' % (filename_of[id], split))
+
+    if pipeline.config['materialise']:
+        images = image_instances(pipeline.cub_directory)
+        materialise_splits(os.path.join(pipeline.cub_directory, 'images'), output, images, assignment)
+
+
+def _shards(pipeline, output, dependencies):
+    config = pipeline.config
+    command = [
+        sys.executable, os.path.join(_SCRIPT_DIRECTORY, 'build_cub200_data.py'),
+        '--images_directory=%s' % os.path.join(pipeline.cub_directory, 'images'),
+        '--output_directory=%s' % output,
+        '--classes_file=%s' % os.path.join(pipeline.cub_directory, 'classes.txt'),
+        '--images_file=%s' % os.path.join(pipeline.cub_directory, 'images.txt'),
+        '--data_split_file=%s' % os.path.join(pipeline.cub_directory, 'train_test_split.txt'),
+        '--bounding_boxes_file=%s' % os.path.join(dependencies['boxes'], 'bounding_boxes_xyxy_norm.txt'),
+        '--split_assignment_file=%s' % os.path.join(dependencies['splits'], 'split_assignment.txt'),
+        '--train_shards=%d' % config['train_shards'],
+        '--validation_shards=%d' % config['validation_shards'],
+        '--num_threads=%d' % config['num_threads'],
+        '--shard_layout=%s' % config['shard_layout'],
+        '--compression=%s' % config['compression'],
+        '--compression_level=%d' % config['compression_level'],
+        '--optimize_jpeg=%s' % config['optimize_jpeg'],
+        '--collect_statistics=%s' % config['collect_statistics'],
+    ]
+    subprocess.check_call(command)
+
+
+STAGES = [
+    Stage('metadata', _metadata,
+          inputs=['CUB_200_2011/images.txt', 'CUB_200_2011/classes.txt', 'CUB_200_2011/train_test_split.txt']),
+    Stage('image_sizes', _image_sizes, ['metadata'], inputs=['CUB_200_2011/images']),
+    Stage('boxes', _boxes, ['metadata', 'image_sizes'], inputs=['CUB_200_2011/bounding_boxes.txt']),
+    Stage('attributes', _attributes,
+          inputs=['attributes.txt', 'CUB_200_2011/attributes/image_attribute_labels.txt'], version=2),
+    Stage('splits', _splits, ['metadata'], config=['validation_fraction', 'seed', 'materialise']),
+    Stage('shards', _shards, ['boxes', 'splits'], inputs=['CUB_200_2011/images'],
+          config=['train_shards', 'validation_shards', 'num_threads', 'shard_layout', 'compression',
+                  'compression_level', 'optimize_jpeg', 'collect_statistics']),
+]
+
+
+def _parse_args(argv):
+    names = [stage.name for stage in STAGES]
+    parser = argparse.ArgumentParser(description='Run the CUB-200-2011 preprocessing pipeline with cached stages.')
+    parser.add_argument('directory', help='CUB-200 data directory containing CUB_200_2011')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help='stages to bring up to date, any of %s (default: all but shards)' % ', '.join(names))
+    parser.add_argument('--status', action='store_true', help='print the cache status of every stage and exit')
+    parser.add_argument('--force', action='append', default=[], choices=names,
+                        help='rerun a stage even if it is cached (repeatable)')
+
+    splits = parser.add_argument_group('splits')
+    splits.add_argument('--validation_fraction', type=float, default=0.1)
+    splits.add_argument('--seed', type=int, default=12345)
+    splits.add_argument('--materialise', action='store_true', help='build train/validation/test link trees')
+
+    shards = parser.add_argument_group('shards (see build_cub200_data.py)')
+    shards.add_argument('--train_shards', type=int, default=1024)
+    shards.add_argument('--validation_shards', type=int, default=128)
+    shards.add_argument('--num_threads', type=int, default=8)
+    shards.add_argument('--shard_layout', default='mixed', choices=['mixed', 'class'])
+    shards.add_argument('--compression', default='none', choices=['none', 'zlib', 'gzip'])
+    shards.add_argument('--compression_level', type=int, default=-1)
+    shards.add_argument('--optimize_jpeg', action='store_true')
+    shards.add_argument('--collect_statistics', action='store_true')
+    args = parser.parse_args(argv)
+    for name in args.stages:
+        if name not in names:
+            parser.error('unknown stage %s, choose from %s' % (name, ', '.join(names)))
+    return args
+
+
+if __name__ == '__main__':
+    args = _parse_args(sys.argv[1:])
+    config = dict((k, v) for k, v in vars(args).items() if k not in ('directory', 'stages', 'status', 'force'))
+    pipeline = Pipeline(args.directory, STAGES, config)
+
+    if args.status:
+        for name in pipeline.order:
+            print('%-12s %s %s' % (name, pipeline.key(name), 'cached' if pipeline.is_cached(name) else 'stale'))
+        sys.exit(0)
+
+    targets = args.stages or [name for name in pipeline.order if name != 'shards']
+    for name in targets:
+        pipeline.build(name, set(args.force))
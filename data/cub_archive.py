@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+# Module containing a reader of the original CUB_200_2011.tgz archive that does not extract it
+
+"""
+The archive is read in a single sequential pass. The metadata text files (images.txt, classes.txt,
+bounding_boxes.txt, train_test_split.txt, ...) are kept in memory and every image member is handed to a
+callback as a file object, so that its bytes can be routed to a shard writer or its header probed in memory
+
+The pass also records the offset and size of every member within the uncompressed tar stream. Saved as a
+member-offset index together with the (small) text members, it lets later passes of an uncompressed .tar read
+the metadata from the index and any image with a direct seek instead of another scan. A gzip stream can only
+seek forward by decompressing, which costs as much as the scan itself, so a .tgz is always scanned.
+An index records the size of its archive and is only used while the size still matches
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import tarfile
+
+
+ROOT = 'CUB_200_2011/'
+IMAGES_PREFIX = ROOT + 'images/'
+
+
+class CUBArchive(object):
+    """Text members and member-offset index of a CUB-200-2011 tar archive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.texts = {}
+        self.index = {}
+
+    def scan(self, on_image=None):
+        """Read the archive once, calling on_image(member name, file object) for every image."""
+        with tarfile.open(self.path, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                self.index[member.name] = (member.offset_data, member.size)
+                if member.name.endswith('.txt'):
+                    self.texts[member.name] = tar.extractfile(member).read().decode('utf8')
+                elif on_image is not None and member.name.startswith(IMAGES_PREFIX):
+                    on_image(member.name, tar.extractfile(member))
+        return self
+
+    def lines(self, name):
+        """Return the lines of a text member, given relative to CUB_200_2011/ (e.g. 'images.txt')."""
+        member = ROOT + name if ROOT + name in self.texts else name
+        if member not in self.texts:
+            raise KeyError('%s not found in %s' % (name, self.path))
+        return self.texts[member].splitlines(True)
+
+    def image_names(self):
+        """Return the member names of all images, in archive order."""
+        names = [n for n in self.index if n.startswith(IMAGES_PREFIX)]
+        return sorted(names, key=lambda n: self.index[n][0])
+
+    def index_path(self):
+        return self.path + '.index.json'
+
+    def write_index(self, index_path=None):
+        """Save the member-offset index, by default next to the archive."""
+        index_path = index_path or self.index_path()
+        with open(index_path, 'w') as file:
+            json.dump({'archive': os.path.basename(self.path), 'size': os.path.getsize(self.path),
+                       'members': self.index, 'texts': self.texts}, file)
+        return index_path
+
+    def seekable(self):
+        """Return True if members can be read with direct seeks, i.e. the archive is not compressed."""
+        return self.path.endswith('.tar')
+
+    def has_index(self, index_path=None):
+        """Return True if a member-offset index of this archive exists."""
+        index_path = index_path or self.index_path()
+        if not os.path.isfile(index_path):
+            return False
+        with open(index_path) as file:
+            index = json.load(file)
+        return index.get('size') == os.path.getsize(self.path) and 'texts' in index
+
+    def load_index(self, index_path=None):
+        """Load a member-offset index and the text members written by write_index."""
+        with open(index_path or self.index_path()) as file:
+            index = json.load(file)
+        self.index = dict((name, tuple(entry)) for name, entry in index['members'].items())
+        self.texts = index['texts']
+        return self
+
+    def read_members(self, names, max_bytes=None):
+        """Yield (name, bytes) of the given members of a seekable archive in archive order.
+        With max_bytes only the first max_bytes of every member are read (e.g. an image header)."""
+        if not names:
+            return
+        assert self.seekable(), 'Members of %s can only be read with a scan' % self.path
+        with open(self.path, 'rb') as file:
+            for name in sorted(names, key=lambda n: self.index[n][0]):
+                offset, size = self.index[name]
+                file.seek(offset)
+                yield name, file.read(size if max_bytes is None else min(size, max_bytes))
+
+
+# Return True if path names a tar archive rather than a directory or text file
+def is_archive(path):
+    return path.endswith(('.tgz', '.tar.gz', '.tar')) and os.path.isfile(path)
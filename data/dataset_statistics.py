@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+# Module containing a mergeable accumulator of dataset statistics for CUB-200-2011
+
+"""
+Statistics are accumulated on the decoded pixels produced while building the TFRecord shards, so that no
+separate decode pass over the images is needed
+
+Each worker keeps its own DatasetStatistics instance which are merged once the workers are done:
+per-channel mean and variance are combined with the parallel algorithm of Chan et al., histograms and
+class counts are summed
+
+The following statistics are collected:
+  per-channel mean and standard deviation of the pixel values in [0, 255]
+  histograms of image widths and heights
+  histogram of bounding box areas relative to the image area
+  number of images per class
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import numpy as np
+
+
+# Fixed bin edges so that histograms of different workers can be summed. Values outside the edges are
+# clipped into the first or last bin (the last image size bin counts every size of at least 992 pixels),
+# so that every histogram sums to the number of images or boxes
+IMAGE_SIZE_BINS = np.arange(0, 1024 + 32, 32)
+BBOX_AREA_BINS = np.linspace(0.0, 1.0, 21)
+
+
+def _histogram(values, bins):
+    return np.histogram(np.clip(values, bins[0], bins[-1]), bins)[0]
+
+
+class DatasetStatistics(object):
+    """Accumulates pixel moments, size and bbox area histograms and class counts."""
+
+    def __init__(self, channels=3):
+        self.num_pixels = 0
+        self.mean = np.zeros(channels, dtype=np.float64)
+        self.m2 = np.zeros(channels, dtype=np.float64)
+        self.width_histogram = np.zeros(len(IMAGE_SIZE_BINS) - 1, dtype=np.int64)
+        self.height_histogram = np.zeros(len(IMAGE_SIZE_BINS) - 1, dtype=np.int64)
+        self.bbox_area_histogram = np.zeros(len(BBOX_AREA_BINS) - 1, dtype=np.int64)
+        self.class_counts = {}
+
+    def _combine(self, count, mean, m2):
+        # Chan et al. update of the running mean and sum of squared deviations
+        total = self.num_pixels + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.num_pixels * count / total)
+        self.num_pixels = total
+
+    def add_pixels(self, image):
+        """Add the pixels of a decoded HxWxC image."""
+        pixels = image.reshape(-1, image.shape[-1]).astype(np.float64)
+        if not len(pixels):
+            return
+        mean = pixels.mean(axis=0)
+        self._combine(len(pixels), mean, ((pixels - mean) ** 2).sum(axis=0))
+
+    def add_example(self, label, height, width, bbox):
+        """Add the metadata of an example.
+        Args:
+          label: integer, class label of the example.
+          height: integer, image height in pixels.
+          width: integer, image width in pixels.
+          bbox: list of normalized [xmin, ymin, xmax, ymax] bounding boxes.
+        """
+        self.class_counts[label] = self.class_counts.get(label, 0) + 1
+        self.width_histogram += _histogram([width], IMAGE_SIZE_BINS)
+        self.height_histogram += _histogram([height], IMAGE_SIZE_BINS)
+        if len(bbox):
+            boxes = np.asarray(bbox, dtype=np.float64)
+            areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            self.bbox_area_histogram += _histogram(areas, BBOX_AREA_BINS)
+
+    def merge(self, other):
+        """Merge the statistics accumulated by another instance into this one."""
+        if other.num_pixels:
+            self._combine(other.num_pixels, other.mean, other.m2)
+        self.width_histogram += other.width_histogram
+        self.height_histogram += other.height_histogram
+        self.bbox_area_histogram += other.bbox_area_histogram
+        for label, count in other.class_counts.items():
+            self.class_counts[label] = self.class_counts.get(label, 0) + count
+        return self
+
+    def to_dict(self):
+        """Return the statistics as a JSON serializable dictionary."""
+        variance = self.m2 / self.num_pixels if self.num_pixels else self.m2
+        return {
+            'num_images': int(sum(self.class_counts.values())),
+            'num_pixels': int(self.num_pixels),
+            'mean': self.mean.tolist(),
+            'std': np.sqrt(variance).tolist(),
+            'image_size_bins': IMAGE_SIZE_BINS.tolist(),
+            'width_histogram': self.width_histogram.tolist(),
+            'height_histogram': self.height_histogram.tolist(),
+            'bbox_area_bins': BBOX_AREA_BINS.tolist(),
+            'bbox_area_histogram': self.bbox_area_histogram.tolist(),
+            'class_counts': dict((str(label), int(count)) for label, count in sorted(self.class_counts.items())),
+        }
+
+
+# Write the statistics of every split and of all splits combined to a JSON descriptor
+def write_statistics(path, split_statistics):
+    total = DatasetStatistics()
+    for statistics in split_statistics.values():
+        total.merge(statistics)
+    descriptor = {
+        'splits': dict((name, statistics.to_dict()) for name, statistics in split_statistics.items()),
+        'total': total.to_dict(),
+    }
+    with open(path, 'w') as file:
+        json.dump(descriptor, file, indent=2, sort_keys=True)
+    return descriptor
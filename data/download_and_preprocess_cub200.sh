@@ -28,6 +28,8 @@ BOUNDING_BOX_SCRIPT="${WORK_DIR}/process_bounding_boxes.py"
 BOUNDING_BOX_FILE="${CUB_DIR}/bounding_boxes.txt"
 IMAGES_FILE="${CUB_DIR}/images.txt"
 python "${BOUNDING_BOX_SCRIPT}" "${BOUNDING_BOX_FILE}" "${IMAGES_FILE}"
+# Converted boxes are written next to the original annotations, which are left untouched
+NORMALIZED_BOUNDING_BOX_FILE="${CUB_DIR}/bounding_boxes_xyxy_norm.txt"
 
 echo "Finished downloading and preprocessing the CUB-200-2011 data."
 
@@ -52,7 +54,7 @@ chmod +x "${BUILD_SCRIPT}"
   --images_directory="${IMAGES_DIRECTORY}" \
   --output_directory="${OUTPUT_DIRECTORY}" \
   --classes_file="${CLASSES_FILE}" \
-  --bounding_boxes_file="${BOUNDING_BOX_FILE}" \
+  --bounding_boxes_file="${NORMALIZED_BOUNDING_BOX_FILE}" \
   --data_split_file="${DATA_SPLIT_FILE}" \
   --images_file="${IMAGES_FILE}"
 
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+# Module containing a sampler of N-way K-shot episodes for few-shot learning on CUB-200-2011
+
+"""
+Episodes are sampled from per-class, per-split index arrays that are computed once from the class labels
+
+An episode consists of N classes drawn without replacement and, for each class, K support and Q query
+images drawn without replacement. Whole batches of episodes are drawn with a handful of vectorised
+NumPy calls, so no Python lists are filtered per episode
+
+The returned indices refer to rows of images.txt (0-based), which makes them usable with any of the
+dataset backends (raw image tree, split directories, TFRecord shards indexed by filename)
+
+Usage: episode_sampler.py <dir> [<n_way> <k_shot> <q_query>]
+
+where <dir> refers to the CUB-200 data directory
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from partition_data import parse_classes
+
+
+# Read images.txt and train_test_split.txt in <dir> and return parallel arrays of image ids,
+# 1-based class labels (following the order of classes.txt, as in build_cub200_data._find_image_files)
+# and split names. Image ids in validation_ids are assigned to the validation split
+def load_labels_and_splits(dir, validation_ids=()):
+    class_names = parse_classes(os.path.join(dir, 'classes.txt'))
+    label_of = dict((name, i + 1) for i, name in enumerate(class_names))
+
+    images = np.loadtxt(os.path.join(dir, 'images.txt'), dtype=str, ndmin=2)
+    split = np.loadtxt(os.path.join(dir, 'train_test_split.txt'), dtype=np.int64, ndmin=2)
+    image_ids = images[:, 0].astype(np.int64)
+    assert np.array_equal(image_ids, split[:, 0]), 'Incongruence between images.txt and train_test_split.txt'
+
+    labels = np.array([label_of[path.split('/')[0]] for path in images[:, 1]], dtype=np.int64)
+    splits = np.where(split[:, 1] == 1, 'train', 'test').astype('<U10')
+    if len(validation_ids):
+        splits[np.isin(image_ids, np.asarray(validation_ids, dtype=np.int64))] = 'validation'
+    return image_ids, labels, splits
+
+
+class EpisodeSampler:
+    """Draws batches of N-way K-shot Q-query episodes from precomputed class index tables."""
+
+    def __init__(self, labels, splits=None, seed=None):
+        labels = np.asarray(labels)
+        if splits is None:
+            splits = np.full(len(labels), 'all')
+        splits = np.asarray(splits)
+        assert len(labels) == len(splits)
+
+        self.rng = np.random.RandomState(seed)
+        self.classes = {}
+        self.tables = {}
+        self.counts = {}
+
+        # For every split build a (num_classes, max_count) table of image indices padded with -1
+        for split in np.unique(splits):
+            indices = np.flatnonzero(splits == split)
+            order = indices[np.argsort(labels[indices], kind='mergesort')]
+            classes, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+
+            table = np.full((len(classes), counts.max()), -1, dtype=np.int64)
+            column = np.arange(len(order)) - np.repeat(starts, counts)
+            table[np.repeat(np.arange(len(classes)), counts), column] = order
+
+            self.classes[split] = classes
+            self.tables[split] = table
+            self.counts[split] = counts
+
+    def sample(self, n_way, k_shot, q_query, num_episodes=1, split=None):
+        """Draw a batch of episodes.
+        Args:
+          n_way: integer, number of classes per episode.
+          k_shot: integer, number of support images per class.
+          q_query: integer, number of query images per class.
+          num_episodes: integer, number of episodes in the batch.
+          split: string, split to sample from. May be omitted when there is a single split.
+        Returns:
+          support: (num_episodes, n_way, k_shot) array of image indices.
+          query: (num_episodes, n_way, q_query) array of image indices.
+          classes: (num_episodes, n_way) array of class labels.
+        """
+        if split is None:
+            assert len(self.tables) == 1, 'Specify one of the splits %s' % sorted(self.tables)
+            split = next(iter(self.tables))
+        shots = k_shot + q_query
+
+        # Only classes with enough images can take part in an episode
+        eligible = np.flatnonzero(self.counts[split] >= shots)
+        if len(eligible) < n_way:
+            raise ValueError('Only %d classes in split %s have %d images, %d-way episodes requested' %
+                             (len(eligible), split, shots, n_way))
+
+        # Draw classes without replacement for every episode at once
+        keys = self.rng.random_sample((num_episodes, len(eligible)))
+        chosen = eligible[np.argsort(keys, axis=1)[:, :n_way]]
+
+        # Draw images without replacement within each chosen class, padding sorts last
+        table = self.tables[split][chosen]
+        keys = self.rng.random_sample(table.shape)
+        keys[table < 0] = np.inf
+        picks = np.take_along_axis(table, np.argsort(keys, axis=2)[:, :, :shots], axis=2)
+
+        return picks[:, :, :k_shot], picks[:, :, k_shot:], self.classes[split][chosen]
+
+
+if __name__ == '__main__':
+    # Quit if invalid arguments
+    if len(sys.argv) not in (2, 5):
+        print('Invalid usage\n'
+              'usage: episode_sampler.py <dir> [<n_way> <k_shot> <q_query>]',
+              file=sys.stderr)
+        sys.exit(-1)
+
+    directory = os.path.join(sys.argv[1], 'CUB_200_2011')
+    n_way, k_shot, q_query = [int(a) for a in sys.argv[2:]] if len(sys.argv) == 5 else (5, 1, 15)
+
+    _, labels, splits = load_labels_and_splits(directory)
+    sampler = EpisodeSampler(labels, splits, seed=12345)
+
+    # Report sampling throughput for each split
+    batch = 1000
+    for split in sorted(sampler.tables):
+        start = time.time()
+        for _ in range(10):
+            sampler.sample(n_way, k_shot, q_query, batch, split)
+        elapsed = time.time() - start
+        print('%s: %d-way %d-shot %d-query, %.0f episodes/s' %
+              (split, n_way, k_shot, q_query, 10 * batch / elapsed))
@@ -1,21 +1,39 @@
 #!/usr/bin/python
 
 """
-Usage: partition_data.py <dir>
+Usage: partition_data.py <dir> [<output_dir>] [--profile[=<report>]]
 
-where <dir> refers to the CUB-200 data directory
+where <dir> refers to the CUB-200 data directory and <output_dir> is the directory that receives the split
+files and directories (defaults to <dir>/splits)
+
+The image ids of each dataset are written to train.txt, validation.txt and test.txt and the datasets are
+materialised as class folder trees without copying any image data:
+
+<output_dir>/train/<label>/<filename>
+<output_dir>/validation/<label>/<filename>
+<output_dir>/test/<label>/<filename>
+
+Each file is a hard link to the original image, falling back to a symbolic link (e.g. across filesystems)
+and to a copy as a last resort. Reruns only touch files whose split assignment changed
+
+With --profile, every step is timed and profiled and a report is written (see profiling.py)
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import errno
 import os
+import shutil
 import sys
 import random
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
+import profiling
+
 
 class CUBImage:
     def __init__(self, identifier, label, file):
@@ -67,33 +85,147 @@ def train_test_split(split_file):
         return train_images, test_images
 
 
+# Datasets materialised by materialise_splits
+SPLITS = ['train', 'validation', 'test']
+
+
+# Split train image ids into train and validation, the validation sample is seeded so that reruns keep the
+# same assignment. Returns a dictionary from split name to image ids
+def split_assignment(train, test, validation_fraction=0.1, seed=12345):
+    sample = random.Random(seed).sample(range(len(train)), int(len(train) * validation_fraction))
+    validation = [train[i] for i in sorted(sample)]
+    validation_ids = set(validation)
+    train = [id for id in train if id not in validation_ids]
+    return {'train': train, 'validation': validation, 'test': test}
+
+
+# Write the image ids of each dataset in <assignment> (dictionary from split name to image ids) to <split>.txt
+def write_split_files(output_dir, assignment):
+    for split in SPLITS:
+        with open(os.path.join(output_dir, split + '.txt'), 'w') as file:
+            for id in assignment[split]:
+                file.write('%s\n' % id)
+
+
+# Make dst refer to the image src, returns how it was done: 'unchanged', 'link', 'symlink' or 'copy'
+# A copy made by an earlier run (copy2 keeps the modification time) is unchanged while its size and
+# modification time match src
+def materialise_file(src, dst):
+    if os.path.lexists(dst):
+        try:
+            if os.path.samefile(src, dst):
+                return 'unchanged'
+            if not os.path.islink(dst):
+                src_info, dst_info = os.stat(src), os.stat(dst)
+                if src_info.st_size == dst_info.st_size and int(src_info.st_mtime) == int(dst_info.st_mtime):
+                    return 'unchanged'
+        except OSError:
+            pass
+        os.remove(dst)
+
+    # Fall back to a symbolic link or a copy only where hard links are not possible, any other error (e.g. a
+    # missing src) is raised rather than leaving a dangling link
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return 'symlink'
+    except (OSError, AttributeError):
+        pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def _materialise_task(task):
+    return materialise_file(*task)
+
+
+# Build <output_dir>/<split>/<label>/<filename> trees for every split in <assignment> (dictionary from split
+# name to image ids) out of the images in <images_dir>, removing files no longer assigned to a split
+# Returns a dictionary counting the files per outcome of materialise_file, plus 'removed'
+def materialise_splits(images_dir, output_dir, images, assignment, num_workers=8):
+    images_by_id = dict((img.id, img) for img in images)
+
+    tasks = []
+    expected = set()
+    for split in SPLITS:
+        for id in assignment[split]:
+            img = images_by_id[id]
+            class_dir = os.path.join(output_dir, split, img.label)
+            if not os.path.isdir(class_dir):
+                try:
+                    os.makedirs(class_dir)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            dst = os.path.join(class_dir, img.filename)
+            expected.add(dst)
+            tasks.append((os.path.join(images_dir, img.label, img.filename), dst))
+
+    # Remove files left over from a previous assignment
+    counts = {'unchanged': 0, 'link': 0, 'symlink': 0, 'copy': 0, 'removed': 0}
+    for split in SPLITS:
+        for root, _, files in os.walk(os.path.join(output_dir, split)):
+            for f in files:
+                path = os.path.join(root, f)
+                if path not in expected:
+                    os.remove(path)
+                    counts['removed'] += 1
+
+    pool = ThreadPool(num_workers)
+    try:
+        for outcome in pool.imap_unordered(_materialise_task, tasks, chunksize=64):
+            counts[outcome] += 1
+    finally:
+        pool.close()
+        pool.join()
+    return counts
+
+
 if __name__ == '__main__':
+    profiling.pop_profile_flag(sys.argv, 'partition_data')
+
     # Quit if invalid arguments
-    if len(sys.argv) != 2:
+    if len(sys.argv) not in (2, 3):
         print('Invalid usage\n'
-              'usage: partition_data.py <dir>',
+              'usage: partition_data.py <dir> [<output_dir>]',
               file=sys.stderr)
         sys.exit(-1)
 
-    directory = sys.argv[1]
-
-    # Read in all class names from classes.txt
-    classes_file = os.path.join(directory, 'CUB_200_2011', 'classes.txt')
-    class_names = parse_classes(classes_file)
-
-    # Collect all image instances from images.txt
-    images_file = os.path.join(directory, 'CUB_200_2011')
-    images = image_instances(images_file)
-
-    # Determine train and test datasets and create validation dataset with 10% of train dataset
-    split_file = os.path.join(directory, 'CUB_200_2011', 'train_test_split.txt')
-    train, test = train_test_split(split_file)
-    validation = [train[i] for i in sorted(random.sample(range(len(train)), int(len(train)/10)))]
-    duplicates = []
-    for i in range(len(train)):
-        if train[i] in validation:
-            duplicates.append(train[i])
-    for dup in duplicates:
-        train.remove(dup)
-
-    # Create directories for train, validation, and test
+    # The report is written even when a stage fails
+    try:
+        directory = sys.argv[1]
+        output_directory = sys.argv[2] if len(sys.argv) == 3 else os.path.join(directory, 'splits')
+
+        # Read in all class names from classes.txt
+        classes_file = os.path.join(directory, 'CUB_200_2011', 'classes.txt')
+        with profiling.stage('parse_classes'):
+            class_names = parse_classes(classes_file)
+
+        # Collect all image instances from images.txt
+        images_file = os.path.join(directory, 'CUB_200_2011')
+        with profiling.stage('image_instances'):
+            images = image_instances(images_file)
+
+        # Determine train and test datasets and create validation dataset with 10% of train dataset
+        split_file = os.path.join(directory, 'CUB_200_2011', 'train_test_split.txt')
+        with profiling.stage('split_assignment'):
+            assignment = split_assignment(*train_test_split(split_file))
+
+        # Create directories for train, validation, and test
+        if not os.path.isdir(output_directory):
+            os.makedirs(output_directory)
+        write_split_files(output_directory, assignment)
+        images_directory = os.path.join(directory, 'CUB_200_2011', 'images')
+        with profiling.stage('materialise_splits'):
+            counts = materialise_splits(images_directory, output_directory, images, assignment)
+        print('Materialised %d train, %d validation and %d test images in %s: '
+              '%d hard links, %d symbolic links, %d copies, %d unchanged, %d removed' %
+              (len(assignment['train']), len(assignment['validation']), len(assignment['test']), output_directory,
+               counts['link'], counts['symlink'], counts['copy'], counts['unchanged'], counts['removed']))
+    finally:
+        profiling.finish()
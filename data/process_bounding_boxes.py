@@ -15,16 +15,37 @@ The x and y coordinates will be normalized in order to account for varying image
 
 This must be done because of the necessary image resizing for feeding images into the network
 
-Usage: process_bounding_boxes.py <bounding_box_file> <images_file>
+All boxes are transformed in a single vectorised pass and written in several conventions next to the
+original annotations (the original file is never modified):
+
+bounding_boxes_xyxy_norm.txt    <filename> <xmin> <ymin> <xmax> <ymax>      normalized to [0, 1]
+bounding_boxes_xyxy_abs.txt     <filename> <xmin> <ymin> <xmax> <ymax>      in pixels
+bounding_boxes_coco_xywh.txt    <filename> <xmin> <ymin> <width> <height>   in pixels
+bounding_boxes_yolo_cxcywh.txt  <filename> <cx> <cy> <width> <height>       normalized to [0, 1]
+
+Each convention is also saved as a float32 .npy array with one row per line of images.txt, together with
+image_sizes.npy (<width> <height>) and bounding_boxes_valid.npy (False for degenerate boxes)
+
+Usage: process_bounding_boxes.py <bounding_box_file> <images_file> [<output_dir>] [--profile[=<report>]]
+       process_bounding_boxes.py <archive> [<output_dir>] [--profile[=<report>]]
 
 where <boudning_box_file> refers to the location of the file containing the original bounding box
-annotations and <images_file> refers to the location of images.txt in order to map image files to image ids
+annotations, <images_file> refers to the location of images.txt in order to map image files to image ids
+and <output_dir> is the directory for the converted files (defaults to the directory of <bounding_box_file>)
+
+Given the original CUB_200_2011.tgz <archive> instead, the annotations are read and the image sizes probed
+in memory in a single pass over the archive, without extracting it (<output_dir> defaults to the directory
+of <archive>). For an uncompressed .tar with a member-offset index saved next to it by build_cub200_data.py,
+only the image headers are read
+
+With --profile, every step is timed and profiled and a report is written (see profiling.py)
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
 import os
 import sys
 
@@ -32,100 +53,163 @@ import numpy as np
 
 from PIL import Image
 
-
-class CUBImage:
-    def __init__(self, identifier, label, file):
-        self.id = identifier
-        self.label = label
-        self.filename = file
-
-
-class Box:
-    def __init__(self, identifier, x, y, width, height):
-        self.id = identifier
-        self.x = x
-        self.y = y
-        self.width = width
-        self.height = height
-
-
-# Read image files in from images.txt in <dir> and return as array of Image instances
-def image_instances(imgs_file):
-    images = np.array([])
-    with open(imgs_file, 'r') as file:
-        lines = file.readlines()
-        for line in lines:
-            img = line.split()
-            id = img[0]
-            desc = img[1]
-            label = desc.split('/')[0]
-            filename = desc.split('/')[1]
-            instance = CUBImage(id, label, filename)
-            images = np.append(images, [instance])
-    return images
-
-
-# Read bounding box information from bounding_boxes.txt and return as array of Box instances
-def bounding_box_instances(bbox_file):
-    boxes = np.array([])
-    with open(bbox_file, 'r') as file:
-        lines = file.readlines()
-        for line in lines:
-            bounding_box = line.split()
-            id = bounding_box[0]
-            x = bounding_box[1]
-            y = bounding_box[2]
-            width = bounding_box[3]
-            height = bounding_box[4]
-            instance = Box(id, x, y, width, height)
-            boxes = np.append(boxes, [instance])
-    return boxes
+import profiling
+from cub_archive import IMAGES_PREFIX, CUBArchive, is_archive
+
+
+# Conventions written by write_box_files, in output order
+BOX_CONVENTIONS = ['xyxy_norm', 'xyxy_abs', 'coco_xywh', 'yolo_cxcywh']
+
+
+# Read images.txt (a path or its lines) and return (ids, relative paths) as parallel arrays
+def load_image_paths(imgs_file):
+    table = np.loadtxt(imgs_file, dtype=str, ndmin=2)
+    return table[:, 0].astype(np.int64), table[:, 1]
+
+
+# Read bounding_boxes.txt (a path or its lines) and return (ids, boxes) where boxes is an (N, 4) float64 array
+# of <x> <y> <width> <height>
+def load_bounding_boxes(bbox_file):
+    table = np.loadtxt(bbox_file, dtype=np.float64, ndmin=2)
+    assert table.shape[1] == 5, ('Failed to parse %s' % bbox_file)
+    return table[:, 0].astype(np.int64), table[:, 1:]
+
+
+# Return an (N, 2) int array of <width> <height> for each image path
+# Only the image header is read, the pixel data is never decoded
+def image_sizes(images_directory, paths):
+    sizes = np.empty((len(paths), 2), dtype=np.int64)
+    for i, path in enumerate(paths):
+        with Image.open(os.path.join(images_directory, path)) as img:
+            sizes[i] = img.size
+    return sizes
+
+
+# Read images.txt and bounding_boxes.txt from the CUB_200_2011.tgz archive and probe the image sizes in memory
+# in a single pass over the archive. For an uncompressed .tar with a member-offset index, the metadata comes from
+# the index and only the first header_bytes of every image are read with seeks (images whose header does not fit
+# are read whole in a second pass). Returns (image ids, paths, box ids, boxes, sizes)
+def load_from_archive(archive_path, header_bytes=1 << 16):
+    header_sizes = {}
+
+    def probe(name, file):
+        with Image.open(io.BytesIO(file.read())) as img:
+            header_sizes[name] = img.size
+
+    archive = CUBArchive(archive_path)
+    if archive.seekable() and archive.has_index():
+        archive.load_index()
+        truncated = []
+        for name, data in archive.read_members(archive.image_names(), header_bytes):
+            try:
+                probe(name, io.BytesIO(data))
+            except IOError:
+                truncated.append(name)
+        for name, data in archive.read_members(truncated):
+            probe(name, io.BytesIO(data))
+    else:
+        archive.scan(probe)
+    image_ids, paths = load_image_paths(archive.lines('images.txt'))
+    box_ids, boxes = load_bounding_boxes(archive.lines('bounding_boxes.txt'))
+    sizes = np.array([header_sizes[IMAGES_PREFIX + p] for p in paths], dtype=np.int64).reshape(-1, 2)
+    return image_ids, paths, box_ids, boxes, sizes
+
+
+# Transform (N, 4) <x> <y> <width> <height> pixel boxes for images of the given (N, 2) sizes
+# Returns a dictionary from each name in BOX_CONVENTIONS to an (N, 4) float32 array and a boolean
+# array that is False for boxes with no area left after clipping to the image
+def transform_boxes(boxes, sizes):
+    boxes = np.asarray(boxes, dtype=np.float64)
+    sizes = np.asarray(sizes, dtype=np.float64)
+    assert boxes.shape[0] == sizes.shape[0]
+
+    # Order the corners (negative widths and heights are tolerated) and clip to the image
+    corners = np.concatenate((boxes[:, :2], boxes[:, :2] + boxes[:, 2:]), axis=1)
+    lo = np.minimum(corners[:, :2], corners[:, 2:])
+    hi = np.maximum(corners[:, :2], corners[:, 2:])
+    lo = np.clip(lo, 0.0, sizes)
+    hi = np.clip(hi, 0.0, sizes)
+
+    xyxy_abs = np.concatenate((lo, hi), axis=1)
+    xyxy_norm = xyxy_abs / np.tile(sizes, 2)
+    extent = hi - lo
+    valid = np.all(extent > 0.0, axis=1)
+
+    conventions = {
+        'xyxy_norm': xyxy_norm,
+        'xyxy_abs': xyxy_abs,
+        'coco_xywh': np.concatenate((lo, extent), axis=1),
+        'yolo_cxcywh': np.concatenate(((xyxy_norm[:, :2] + xyxy_norm[:, 2:]) / 2.0,
+                                       xyxy_norm[:, 2:] - xyxy_norm[:, :2]), axis=1),
+    }
+    for name in conventions:
+        conventions[name] = conventions[name].astype(np.float32)
+    return conventions, valid
+
+
+# Write every convention as bounding_boxes_<name>.txt and bounding_boxes_<name>.npy in output_dir
+def write_box_files(output_dir, filenames, conventions, sizes, valid):
+    for name in BOX_CONVENTIONS:
+        values = conventions[name]
+        stem = os.path.join(output_dir, 'bounding_boxes_%s' % name)
+        np.save(stem + '.npy', values)
+        rows = np.column_stack((filenames, np.char.mod('%.4f', values)))
+        np.savetxt(stem + '.txt', rows, fmt='%s')
+    np.save(os.path.join(output_dir, 'image_sizes.npy'), sizes.astype(np.int32))
+    np.save(os.path.join(output_dir, 'bounding_boxes_valid.npy'), valid)
 
 
 if __name__ == '__main__':
+    profiling.pop_profile_flag(sys.argv, 'process_bounding_boxes')
+
     # Quit if invalid arguments
-    if len(sys.argv) != 3:
+    archive_mode = len(sys.argv) in (2, 3) and is_archive(sys.argv[1])
+    if not archive_mode and len(sys.argv) not in (3, 4):
         print('Invalid usage\n'
-              'usage: process_bounding_boxes.py <bounding_box_file> <images_file>',
+              'usage: process_bounding_boxes.py <bounding_box_file> <images_file> [<output_dir>]\n'
+              '       process_bounding_boxes.py <archive> [<output_dir>]',
               file=sys.stderr)
         sys.exit(-1)
 
-    bbox_file = sys.argv[1]
-    imgs_file = sys.argv[2]
-
-    # Call methods to acquire image and bounding box instances
-    images = image_instances(imgs_file)
-    boxes = bounding_box_instances(bbox_file)
-
-    # Var for images directory
-    images_directory = os.path.join(os.getcwd(), 'data', 'raw-data', 'CUB_200_2011', 'images')
-
-    # Make sure there is an equal number of images and bounding boxes (arrays are parallel)
-    assert (len(images) == len(boxes))
-
-    # Open the new file and calculate new information to be written
-    with open(bbox_file, 'w') as file:
-        # Iterate over image instances and create new bounding box instances with updated information
-        for (image, box) in zip(images, boxes):
-            image_file = os.path.join(images_directory, image.label, image.filename)
-            img = Image.open(image_file)
-            img_width, img_height = img.size
-
-            # Calculate relative x and y coordinates for bounding box
-            xmin = float(box.x) / float(img_width)
-            xmax = (float(box.x) + float(box.width)) / float(img_width)
-            ymin = float(box.y) / float(img_height)
-            ymax = (float(box.y) + float(box.height)) / float(img_height)
-
-            min_x = min(xmin, xmax)
-            max_x = max(xmin, xmax)
-            xmin_scaled = min(max(min_x, 0.0), 1.0)
-            xmax_scaled = min(max(max_x, 0.0), 1.0)
-
-            min_y = min(ymin, ymax)
-            max_y = max(ymin, ymax)
-            ymin_scaled = min(max(min_y, 0.0), 1.0)
-            ymax_scaled = min(max(max_y, 0.0), 1.0)
-
-            # Write updated information to new file
-            file.write('%s %.4f %.4f %.4f %.4f\n' % (image.filename, xmin_scaled, ymin_scaled, xmax_scaled, ymax_scaled))
+    # The report is written even when a stage fails
+    try:
+        if archive_mode:
+            # Load everything from the archive in one pass
+            output_dir = sys.argv[2] if len(sys.argv) == 3 else os.path.dirname(os.path.abspath(sys.argv[1]))
+            with profiling.stage('load_from_archive'):
+                image_ids, paths, box_ids, boxes, sizes = load_from_archive(sys.argv[1])
+            assert np.array_equal(image_ids, box_ids), 'Image ids of images.txt and bounding_boxes.txt do not match'
+        else:
+            bbox_file = sys.argv[1]
+            imgs_file = sys.argv[2]
+            output_dir = sys.argv[3] if len(sys.argv) == 4 else os.path.dirname(os.path.abspath(bbox_file))
+
+            # Load image paths and bounding boxes as parallel arrays
+            with profiling.stage('load_annotations'):
+                image_ids, paths = load_image_paths(imgs_file)
+                box_ids, boxes = load_bounding_boxes(bbox_file)
+
+            # Make sure there is an equal number of images and bounding boxes (arrays are parallel)
+            assert (len(image_ids) == len(box_ids))
+            assert np.array_equal(image_ids, box_ids), 'Image ids in %s and %s do not match' % (imgs_file, bbox_file)
+
+            # Images live in the images directory next to images.txt
+            images_directory = os.path.join(os.path.dirname(os.path.abspath(imgs_file)), 'images')
+            with profiling.stage('image_sizes'):
+                sizes = image_sizes(images_directory, paths)
+
+        with profiling.stage('transform_boxes'):
+            conventions, valid = transform_boxes(boxes, sizes)
+        if not valid.all():
+            print('Found %d degenerate bounding boxes: %s' % (np.count_nonzero(~valid), paths[~valid]),
+                  file=sys.stderr)
+
+        # Write the converted boxes to new files, the original annotations are left untouched
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        filenames = np.array([os.path.basename(p) for p in paths])
+        with profiling.stage('write_box_files'):
+            write_box_files(output_dir, filenames, conventions, sizes, valid)
+        print('Wrote %d bounding boxes in %d conventions to %s' % (len(filenames), len(BOX_CONVENTIONS), output_dir))
+    finally:
+        profiling.finish()
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+# Module containing opt-in per-stage profiling for the CUB-200-2011 preprocessing scripts
+
+"""
+Named stages are wrapped with the stage() context manager, which does nothing unless profiling was enabled
+(the --profile option of the scripts). When enabled, every stage records:
+
+  wall time, CPU time of the process (all threads) and of finished child processes
+  peak traced Python memory (tracemalloc) and the peak RSS of the process during the stage, sampled from
+  /proc/self/statm (Linux only), next to the lifetime high-water marks of the RSS of the process and its children
+  the top allocation sites, i.e. the lines holding the most memory allocated during the stage
+  the hot functions, from stacks of all threads sampled at a fixed interval (self and cumulative samples)
+
+Worker threads are covered by the stack sampler and by tracemalloc, child processes by their resource usage.
+All stages of a run end up in a single JSON report, summarised on stderr
+
+Usage in a script:
+  profiling.pop_profile_flag(sys.argv, 'partition_data')
+  ...
+  with profiling.stage('materialise'):
+      ...
+  profiling.finish()
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+TOP_ENTRIES = 10
+SAMPLE_INTERVAL = 0.005
+
+# tracemalloc.reset_peak() needs Python 3.9. Older interpreters (those running the TF1 builder) fall back to the
+# largest traced size seen by the stack sampler, which may miss short allocation spikes
+_RESET_PEAK = hasattr(tracemalloc, 'reset_peak')
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_profiler = None
+_source = __file__
+
+
+def _max_rss_mb(who):
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+
+def _current_rss_mb():
+    # Resident pages of the process, None where /proc is not available
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * _PAGE_SIZE / float(1 << 20)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _max_rss(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def _snapshot():
+    # Allocations of tracemalloc and of the profiler itself are left out of the allocation sites
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, _source),
+    ])
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.child_peak = 0
+        self.sampled_peak = 0
+        self.rss_peak = _current_rss_mb()
+        self.self_samples = collections.Counter()
+        self.cumulative_samples = collections.Counter()
+        self.wall = time.time()
+        self.cpu = time.process_time()
+        self.children_cpu = _children_cpu()
+        self.snapshot = _snapshot()
+
+
+class Profiler(object):
+    """Collects stage records and samples the stacks of all threads."""
+
+    def __init__(self, report_path):
+        self.report_path = report_path
+        self.records = []
+        self._stack = []
+        self._lock = threading.Lock()
+        self._running = True
+        tracemalloc.start()
+        self._sampler = threading.Thread(target=self._sample, name='profiling-sampler')
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def _sample(self):
+        own = threading.current_thread().ident
+        while self._running:
+            time.sleep(SAMPLE_INTERVAL)
+            with self._lock:
+                if not self._stack:
+                    continue
+                current = self._stack[-1]
+                if not _RESET_PEAK:
+                    current.sampled_peak = max(current.sampled_peak, tracemalloc.get_traced_memory()[0])
+                current.rss_peak = _max_rss(current.rss_peak, _current_rss_mb())
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(frame.f_code)
+                        frame = frame.f_back
+                    # Threads inside the profiler (taking snapshots between stages) are not sampled
+                    if any(code.co_filename == _source for code in stack):
+                        continue
+                    functions = ['%s:%d(%s)' % (os.path.basename(code.co_filename), code.co_firstlineno,
+                                                code.co_name) for code in stack]
+                    current.self_samples[functions[0]] += 1
+                    current.cumulative_samples.update(set(functions))
+
+    def _peak(self, stage):
+        # Peak traced memory since the stage was entered or its last child stage ended
+        if _RESET_PEAK:
+            return tracemalloc.get_traced_memory()[1]
+        return max(tracemalloc.get_traced_memory()[0], stage.sampled_peak)
+
+    def enter(self, name):
+        with self._lock:
+            peak = self._peak(self._stack[-1]) if self._stack else 0
+        stage = _Stage(name)
+        with self._lock:
+            if self._stack:
+                self._stack[-1].child_peak = max(self._stack[-1].child_peak, peak)
+            self._stack.append(stage)
+        if _RESET_PEAK:
+            tracemalloc.reset_peak()
+        return stage
+
+    def exit(self, stage):
+        wall = time.time() - stage.wall
+        cpu = time.process_time() - stage.cpu
+        children_cpu = _children_cpu() - stage.children_cpu
+        peak = max(self._peak(stage), stage.child_peak)
+        allocations = _snapshot().compare_to(stage.snapshot, 'lineno')
+        with self._lock:
+            rss_peak = _max_rss(stage.rss_peak, _current_rss_mb())
+            self._stack.remove(stage)
+            if self._stack:
+                self._stack[-1].child_peak = max(self._stack[-1].child_peak, peak)
+                self._stack[-1].rss_peak = _max_rss(self._stack[-1].rss_peak, rss_peak)
+
+        self.records.append({
+            'stage': stage.name,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'children_cpu_seconds': children_cpu,
+            'traced_peak_mb': peak / float(1 << 20),
+            'rss_peak_mb': rss_peak,
+            # High-water marks over the lifetime of the process, not of the stage
+            'lifetime_max_rss_mb': _max_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            'children_lifetime_max_rss_mb': _max_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+            'top_allocations': [
+                {'site': str(diff.traceback[0]), 'size_mb': diff.size_diff / float(1 << 20),
+                 'count': diff.count_diff}
+                for diff in sorted(allocations, key=lambda d: d.size_diff, reverse=True)[:TOP_ENTRIES]
+                if diff.size_diff > 0],
+            'hot_functions': [
+                {'function': function, 'self_samples': stage.self_samples[function], 'cumulative_samples': count}
+                for function, count in stage.cumulative_samples.most_common(TOP_ENTRIES)],
+            'self_hot_functions': [
+                {'function': function, 'self_samples': count}
+                for function, count in stage.self_samples.most_common(TOP_ENTRIES)],
+        })
+
+    def finish(self):
+        self._running = False
+        self._sampler.join()
+        tracemalloc.stop()
+        with open(self.report_path, 'w') as file:
+            json.dump({'argv': sys.argv, 'stages': self.records}, file, indent=2)
+
+        for record in self.records:
+            print('[profile] %s: wall %.2f s, cpu %.2f s (+%.2f s children), traced peak %.1f MB, rss peak %s MB' %
+                  (record['stage'], record['wall_seconds'], record['cpu_seconds'], record['children_cpu_seconds'],
+                   record['traced_peak_mb'], '%.1f' % record['rss_peak_mb'] if record['rss_peak_mb'] else '?'),
+                  file=sys.stderr)
+            for entry in record['self_hot_functions'][:3]:
+                print('[profile]     hot %s (%d samples)' % (entry['function'], entry['self_samples']),
+                      file=sys.stderr)
+            for entry in record['top_allocations'][:3]:
+                print('[profile]     alloc %s (%.1f MB)' % (entry['site'], entry['size_mb']), file=sys.stderr)
+        print('[profile] Wrote profiling report to %s' % self.report_path, file=sys.stderr)
+
+
+def enable(report_path):
+    """Start profiling, the report is written to report_path by finish()."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(report_path)
+    return _profiler
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Profile the enclosed block as a named stage when profiling is enabled."""
+    if _profiler is None:
+        yield
+        return
+    record = _profiler.enter(name)
+    try:
+        yield
+    finally:
+        _profiler.exit(record)
+
+
+def finish():
+    """Stop profiling and write the report, if profiling is enabled."""
+    global _profiler
+    if _profiler is not None:
+        _profiler.finish()
+        _profiler = None
+
+
+# Remove --profile or --profile=<report> from argv and enable profiling if it was given. The report defaults to
+# <script>_profile.json in the working directory
+def pop_profile_flag(argv, script):
+    for i, arg in enumerate(argv):
+        if arg == '--profile' or arg.startswith('--profile='):
+            del argv[i]
+            enable(arg.split('=', 1)[1] if '=' in arg else '%s_profile.json' % script)
+            return
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+# Module containing the compression settings of the TFRecord shards written by build_cub200_data.py
+
+"""
+Shards can be written with ZLIB or GZIP framing at a configurable level. Independently, the JPEG data stored in
+image/encoded can be optimised losslessly with jpegtran, which recomputes optimal Huffman tables and strips
+metadata (EXIF, comments, ICC profiles) without touching the DCT coefficients
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import subprocess
+
+
+COMPRESSION_TYPES = ['none', 'zlib', 'gzip']
+
+# Compression types as understood by tf.python_io.TFRecordOptions
+_TF_COMPRESSION_TYPES = {'none': '', 'zlib': 'ZLIB', 'gzip': 'GZIP'}
+
+_JPEGTRAN = ['jpegtran', '-copy', 'none', '-optimize']
+
+
+# Return the tf.python_io.TFRecordOptions for a compression type and level (-1 for the zlib default)
+def record_options(compression, level=-1):
+    import tensorflow as tf
+
+    assert compression in COMPRESSION_TYPES, 'Unknown compression: %s' % compression
+    if compression == 'none':
+        return None
+    if level < 0:
+        return tf.python_io.TFRecordOptions(_TF_COMPRESSION_TYPES[compression])
+    return tf.python_io.TFRecordOptions(_TF_COMPRESSION_TYPES[compression], compression_level=level)
+
+
+# Return True if jpegtran can be run
+def jpegtran_available():
+    try:
+        subprocess.check_output(_JPEGTRAN, input=b'', stderr=subprocess.STDOUT)
+    except OSError:
+        return False
+    except subprocess.CalledProcessError:
+        pass
+    return True
+
+
+# Losslessly optimise JPEG data, keeping the original data when it is not a JPEG or does not get smaller
+def optimize_jpeg(image_data):
+    if not image_data.startswith(b'\xff\xd8'):
+        return image_data
+    try:
+        optimized = subprocess.check_output(_JPEGTRAN, input=image_data, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return image_data
+    return optimized if 0 < len(optimized) < len(image_data) else image_data
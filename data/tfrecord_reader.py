@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# Module containing a TensorFlow-free reader for the TFRecord shards written by build_cub200_data.py
+
+"""
+A TFRecord file is a sequence of records framed as:
+
+<uint64 length> <uint32 masked crc of length> <length bytes of data> <uint32 masked crc of data>
+
+where the data of each record is a serialized tf.train.Example protocol buffer. This module locates the records
+of a shard in a memory map and decodes the Example protos with a minimal protocol buffer parser, so that
+readers do not need to import TensorFlow
+
+Shards written with ZLIB or GZIP compression are decompressed into memory instead of being memory-mapped
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+
+_LENGTH = struct.Struct('<Q')
+# Length, length crc and data crc
+_HEADER_SIZE = 12
+_FOOTER_SIZE = 4
+
+# zlib window bits of the compression types of shard_compression.COMPRESSION_TYPES
+_WINDOW_BITS = {'zlib': zlib.MAX_WBITS, 'gzip': 16 + zlib.MAX_WBITS}
+
+
+# Memory map a shard file read-only
+def map_shard(path):
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# Return a buffer holding the records of a shard, memory-mapped when uncompressed
+def load_shard(path, compression='none'):
+    if compression == 'none':
+        return map_shard(path)
+    assert compression in _WINDOW_BITS, 'Unknown compression: %s' % compression
+    with open(path, 'rb') as file:
+        return zlib.decompressobj(_WINDOW_BITS[compression]).decompress(file.read())
+
+
+# Return the (offset, length) of the data of every record in a buffer holding a TFRecord file
+def record_offsets(buffer):
+    offsets = []
+    position = 0
+    size = len(buffer)
+    while position < size:
+        assert position + _HEADER_SIZE <= size, 'Truncated record header at byte %d' % position
+        length = _LENGTH.unpack_from(buffer, position)[0]
+        start = position + _HEADER_SIZE
+        assert start + length + _FOOTER_SIZE <= size, 'Truncated record at byte %d' % position
+        offsets.append((start, length))
+        position = start + length + _FOOTER_SIZE
+    return offsets
+
+
+def _varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+# Yield (field number, wire type, value) for every field of a serialized protocol buffer message, where the
+# value of length delimited fields is a memoryview
+def _fields(data):
+    data = memoryview(data)
+    position = 0
+    while position < len(data):
+        key, position = _varint(data, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = _varint(data, position)
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 2:
+            length, position = _varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == 5:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise ValueError('Unsupported wire type %d' % wire_type)
+        yield field, wire_type, value
+
+
+def _signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _parse_feature(data):
+    for kind, _, value_list in _fields(data):
+        values = []
+        for _, wire_type, value in _fields(value_list):
+            if kind == 1:
+                values.append(value.tobytes())
+            elif kind == 2:
+                values.extend(np.frombuffer(value, dtype='<f4').tolist())
+            elif wire_type == 2:
+                position = 0
+                while position < len(value):
+                    number, position = _varint(value, position)
+                    values.append(_signed(number))
+            else:
+                values.append(_signed(value))
+        return values
+    return []
+
+
+# Decode a serialized tf.train.Example into a dictionary from feature name to list of values
+# (bytes for bytes lists, floats for float lists and integers for int64 lists)
+def parse_example(data):
+    features = {}
+    for field, _, message in _fields(data):
+        if field != 1:
+            continue
+        for entry_field, _, entry in _fields(message):
+            if entry_field != 1:
+                continue
+            name = None
+            feature = b''
+            for item_field, _, value in _fields(entry):
+                if item_field == 1:
+                    name = value.tobytes().decode('utf8')
+                elif item_field == 2:
+                    feature = value
+            features[name] = _parse_feature(feature)
+    return features